@@ -0,0 +1,4 @@
+import time
+
+# Taken before any other app module loads, see the startup_seconds metric
+IMPORT_STARTED = time.perf_counter()
@@ -0,0 +1,209 @@
+"""Content-addressed attachment storage
+
+Attachment bytes are stored once per distinct content, in a file named by
+their SHA-256 under ATTACHMENT_DIR. Rows in ``attachment`` point notes at
+those files, so uploading the same file twice (or to two notes) costs one
+copy on disk.
+
+Uploads are hashed while they stream into a temporary file, which is then
+renamed into place. Deleting rows never touches the files; a sweep
+removes files no row refers to once they are older than ATTACHMENT_GRACE,
+which also covers uploads still between placing their file and committing.
+The sweep runs every ATTACHMENT_SWEEP_INTERVAL seconds in each worker.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from typing import AsyncIterator, List, Optional, Tuple
+
+import anyio
+from sqlmodel import col, select
+
+from app.database import session_factory
+from app.metrics import metrics
+from app.models import Attachment
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", "/app/data/attachments")
+# Largest upload accepted, in bytes
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(50 * 1024 * 1024)))
+# Seconds an unreferenced file is kept before the sweep deletes it
+ATTACHMENT_GRACE = float(os.getenv("ATTACHMENT_GRACE", "3600"))
+# Seconds between sweeps for unreferenced files, 0 disables the sweeper
+ATTACHMENT_SWEEP_INTERVAL = float(os.getenv("ATTACHMENT_SWEEP_INTERVAL", "3600"))
+# Files looked up per query while sweeping
+ATTACHMENT_SWEEP_BATCH_SIZE = 500
+
+_TEMP_DIR = "tmp"
+
+_sweeper_task: Optional[asyncio.Task] = None
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def blob_path(digest: str) -> str:
+    # A level of 256 directories keeps any one directory small
+    return os.path.join(ATTACHMENT_DIR, digest[:2], digest)
+
+
+class _Upload:
+    """A temporary file that hashes what is written to it"""
+
+    def __init__(self) -> None:
+        temp_dir = os.path.join(ATTACHMENT_DIR, _TEMP_DIR)
+        os.makedirs(temp_dir, exist_ok=True)
+        # Same filesystem as the blobs, so placing the file is a rename
+        fd, self.path = tempfile.mkstemp(dir=temp_dir)
+        self.file = os.fdopen(fd, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes) -> None:
+        # hashlib releases the GIL on large buffers, so this runs in a thread
+        self.hash.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def place(self) -> str:
+        """Move the file to its content address and return the digest"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        digest = self.hash.hexdigest()
+        path = blob_path(digest)
+        if os.path.exists(path):
+            # Already stored; a fresh mtime keeps the sweep away from it
+            os.utime(path)
+            os.unlink(self.path)
+            metrics.inc("attachment_dedup_hits")
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.path, path)
+        return digest
+
+    def discard(self) -> None:
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+async def store_stream(
+    chunks: AsyncIterator[bytes], max_bytes: int = ATTACHMENT_MAX_BYTES
+) -> Tuple[str, int]:
+    """Write a stream to its content address and return ``(digest, size)``
+
+    Only one chunk is held in memory at a time. Raises UploadTooLarge as soon
+    as the stream passes ``max_bytes``.
+    """
+    upload = await anyio.to_thread.run_sync(_Upload)
+    try:
+        async for chunk in chunks:
+            if upload.size + len(chunk) > max_bytes:
+                raise UploadTooLarge()
+            if chunk:
+                await anyio.to_thread.run_sync(upload.write, chunk)
+        digest = await anyio.to_thread.run_sync(upload.place)
+    except BaseException:
+        await anyio.to_thread.run_sync(upload.discard)
+        raise
+    metrics.inc("attachment_bytes_uploaded", upload.size)
+    return digest, upload.size
+
+
+def _stale_files(cutoff: float) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """``(digest, path)`` of blobs and paths of temp files older than ``cutoff``"""
+    blobs: List[Tuple[str, str]] = []
+    temps: List[str] = []
+    if not os.path.isdir(ATTACHMENT_DIR):
+        return blobs, temps
+    for directory in os.scandir(ATTACHMENT_DIR):
+        if not directory.is_dir():
+            continue
+        for entry in os.scandir(directory.path):
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+            if directory.name == _TEMP_DIR:
+                temps.append(entry.path)
+            else:
+                blobs.append((entry.name, entry.path))
+    return blobs, temps
+
+
+def _unlink_stale(paths: List[str], cutoff: float) -> int:
+    removed = 0
+    for path in paths:
+        try:
+            # Checked again in case an upload reused the file since the scan
+            if os.stat(path).st_mtime < cutoff:
+                os.unlink(path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+async def sweep_attachments(grace: float = ATTACHMENT_GRACE) -> int:
+    """Delete stored files no attachment refers to, returning how many"""
+    cutoff = time.time() - grace
+    blobs, temps = await anyio.to_thread.run_sync(_stale_files, cutoff)
+
+    orphans = list(temps)
+    for start in range(0, len(blobs), ATTACHMENT_SWEEP_BATCH_SIZE):
+        batch = dict(blobs[start:start + ATTACHMENT_SWEEP_BATCH_SIZE])
+        async with session_factory() as session:
+            result = await session.exec(
+                select(Attachment.digest)
+                .where(col(Attachment.digest).in_(batch))
+                .distinct()
+            )
+            referenced = set(result.all())
+        orphans.extend(path for digest, path in batch.items() if digest not in referenced)
+
+    removed = await anyio.to_thread.run_sync(_unlink_stale, orphans, cutoff)
+    metrics.inc("attachment_files_swept", removed)
+    return removed
+
+
+async def run_sweeper(interval: float) -> None:
+    while True:
+        try:
+            await sweep_attachments()
+        except Exception:
+            metrics.inc("attachment_sweep_errors")
+            logger.exception("Attachment sweep failed")
+        await asyncio.sleep(interval)
+
+
+def start_sweeper() -> None:
+    global _sweeper_task
+    if ATTACHMENT_SWEEP_INTERVAL > 0 and _sweeper_task is None:
+        _sweeper_task = asyncio.create_task(run_sweeper(ATTACHMENT_SWEEP_INTERVAL))
+
+
+async def stop_sweeper() -> None:
+    global _sweeper_task
+    if _sweeper_task is not None:
+        _sweeper_task.cancel()
+        try:
+            await _sweeper_task
+        except asyncio.CancelledError:
+            pass
+        _sweeper_task = None
+
+
+async def stat_blob(digest: str) -> Optional[os.stat_result]:
+    try:
+        return await anyio.to_thread.run_sync(os.stat, blob_path(digest))
+    except FileNotFoundError:
+        return None
@@ -1,68 +1,275 @@
+import asyncio
+import multiprocessing
+import os
 import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, replace
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Any, Callable, Dict, Optional
 
-import bcrypt
-from fastapi import Cookie, Depends, HTTPException, Request, status
-from sqlmodel import Session, select
+from fastapi import Cookie, Depends, HTTPException, Request, Response, status
+from sqlalchemy import update
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from app import passwords
+from app.cache import TTLCache
 from app.database import get_session
+from app.events import get_broker, on_notice
+from app.metrics import metrics
 from app.models import Session as SessionModel
 from app.models import User
 
 
-def hash_password(password: str) -> str:
-    password_bytes = password.encode("utf-8")
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password_bytes, salt)
-    return hashed.decode("utf-8")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(
+    os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1)))
+)
+# Hash jobs allowed to wait or run at once before logins are turned away
+PASSWORD_HASH_MAX_PENDING = int(
+    os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 8))
+)
 
+SESSION_LIFETIME = timedelta(days=30)
+# Push a session's expiry forward when it is used, writing at most once per
+# this many seconds per session. 0 keeps the fixed lifetime set at login.
+SESSION_RENEW_INTERVAL = float(os.getenv("SESSION_RENEW_INTERVAL", "0"))
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    password_bytes = plain_password.encode("utf-8")
-    hashed_bytes = hashed_password.encode("utf-8")
-    return bcrypt.checkpw(password_bytes, hashed_bytes)
+_hash_pool: Optional[ProcessPoolExecutor] = None
+_hash_pending = 0
 
 
-def create_session(
-    user_id: int, request: Request, db: Session, expires_in_days: int = 30
+def get_hash_pool() -> ProcessPoolExecutor:
+    global _hash_pool
+    if _hash_pool is None:
+        _hash_pool = ProcessPoolExecutor(
+            max_workers=PASSWORD_HASH_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _hash_pool
+
+
+def shutdown_hash_pool() -> None:
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown(cancel_futures=True)
+        _hash_pool = None
+
+
+def discard_hash_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a pool that lost a worker, so the next job starts a fresh one"""
+    global _hash_pool
+    if _hash_pool is pool:
+        _hash_pool = None
+        metrics.inc("password_hash_pool_restarts")
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_password_job(fn: Callable[..., Any], *args: Any) -> Any:
+    """Run a bcrypt call in the worker pool, shedding load when it is backed up"""
+    global _hash_pending
+    if _hash_pending >= PASSWORD_HASH_MAX_PENDING:
+        metrics.inc("password_hash_rejected")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts in progress, try again shortly",
+            headers={"Retry-After": "1"},
+        )
+
+    _hash_pending += 1
+    submitted = time.time()
+    loop = asyncio.get_running_loop()
+    try:
+        pool = get_hash_pool()
+        try:
+            result, started, elapsed = await loop.run_in_executor(
+                pool, passwords.timed, fn, *args
+            )
+        except BrokenProcessPool:
+            # A worker died (OOM kill, crash), which breaks the whole pool
+            discard_hash_pool(pool)
+            result, started, elapsed = await loop.run_in_executor(
+                get_hash_pool(), passwords.timed, fn, *args
+            )
+    finally:
+        _hash_pending -= 1
+
+    metrics.observe("password_hash_queue_wait_seconds", max(0.0, started - submitted))
+    metrics.observe("password_hash_seconds", elapsed)
+    return result
+
+
+async def hash_password(password: str) -> str:
+    return await run_password_job(passwords.hash_password, password, BCRYPT_ROUNDS)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await run_password_job(
+        passwords.verify_password, plain_password, hashed_password
+    )
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    return passwords.hash_rounds(hashed_password) != BCRYPT_ROUNDS
+
+
+async def create_session(
+    user_id: int,
+    request: Request,
+    db: AsyncSession,
+    lifetime: timedelta = SESSION_LIFETIME,
 ) -> str:
     session_id = secrets.token_urlsafe(32)
-    expires_at = datetime.now() + timedelta(days=expires_in_days)
+    expires_at = datetime.now() + lifetime
 
     db_session = SessionModel(
         session_id=session_id,
         user_id=user_id,
         expires_at=expires_at,
         ip_address=request.client.host,
-        user_agent=request.headers.get("user-agent"),
+        user_agent=(request.headers.get("user-agent") or "")[:255] or None,
     )
     db.add(db_session)
-    db.commit()
+    await db.commit()
 
     return session_id
 
 
-def get_session_user(session_id: Optional[str], db: Session) -> Optional[User]:
+def set_session_cookie(response: Response, session_id: str) -> None:
+    response.set_cookie(
+        key="session_id",
+        value=session_id,
+        httponly=True,
+        secure=True,
+        samesite="lax",
+        max_age=int(SESSION_LIFETIME.total_seconds()),
+    )
+
+
+# User columns kept in the session cache: what request handlers read. The
+# password hash stays in the database.
+CACHED_USER_FIELDS = {"id", "username", "email", "salt", "wrapped_master_key"}
+
+
+@dataclass(frozen=True)
+class CachedSession:
+    user_id: int
+    expires_at: datetime
+    user: Dict[str, Any]
+
+
+# Session token -> user snapshot. Revocations are broadcast through the event
+# broker, so every worker evicts the entry at once (with EVENTS_BROKER=unix,
+# which start.sh picks for several workers). The TTL bounds how long a lost
+# notice can keep a revoked session alive.
+session_cache: TTLCache[CachedSession] = TTLCache(
+    "session_cache",
+    maxsize=int(os.getenv("SESSION_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("SESSION_CACHE_TTL", "60")),
+)
+
+
+SESSION_REVOKED = "session_revoked"
+on_notice(SESSION_REVOKED, session_cache.invalidate)
+
+
+def invalidate_session(session_id: str) -> None:
+    get_broker().broadcast(SESSION_REVOKED, session_id)
+
+
+async def load_session(
+    session_id: Optional[str], db: AsyncSession
+) -> Optional[CachedSession]:
     if not session_id:
         return None
 
-    session = db.exec(
-        select(SessionModel).where(SessionModel.session_id == session_id)
-    ).first()
+    now = datetime.now()
+    cached = session_cache.get(session_id)
+    if cached is not None:
+        if cached.expires_at < now:
+            session_cache.invalidate(session_id)
+            return None
+        return cached
+
+    result = await db.exec(
+        select(SessionModel, User)
+        .join(User, User.id == SessionModel.user_id)  # pyright: ignore[reportArgumentType]
+        .where(SessionModel.session_id == session_id)
+    )
+    row = result.first()
+
+    if not row:
+        return None
 
-    if not session or session.expires_at < datetime.now():
+    session, user = row
+    if session.expires_at < now:
         return None
 
-    return session.user
+    cached = CachedSession(
+        user_id=session.user_id,
+        expires_at=session.expires_at,
+        user=user.model_dump(include=CACHED_USER_FIELDS),
+    )
+    session_cache.set(session_id, cached, ttl=(session.expires_at - now).total_seconds())
+    return cached
+
+
+async def get_session_user(
+    session_id: Optional[str], db: AsyncSession
+) -> Optional[User]:
+    cached = await load_session(session_id, db)
+    return User(**cached.user) if cached is not None else None
+
+
+def needs_renewal(cached: CachedSession, now: datetime) -> bool:
+    """Whether a sliding renewal is due, judged from the stored expiry alone
+
+    A session renewed at time t expires at t + SESSION_LIFETIME, so the time
+    since its last renewal can be read back without storing anything extra.
+    """
+    if SESSION_RENEW_INTERVAL <= 0:
+        return False
+    last_renewed = cached.expires_at - SESSION_LIFETIME
+    return (now - last_renewed).total_seconds() >= SESSION_RENEW_INTERVAL
+
+
+async def renew_session(
+    session_id: str, cached: CachedSession, db: AsyncSession
+) -> None:
+    now = datetime.now()
+    expires_at = now + SESSION_LIFETIME
+    result = await db.execute(
+        update(SessionModel)
+        .where(col(SessionModel.session_id) == session_id)
+        .values(expires_at=expires_at),
+        execution_options={"synchronize_session": False},
+    )
+    await db.commit()
+    if result.rowcount != 1:  # pyright: ignore[reportAttributeAccessIssue]
+        # Revoked since it was loaded; caching it again would revive it
+        return
+    session_cache.set(
+        session_id,
+        replace(cached, expires_at=expires_at),
+        ttl=SESSION_LIFETIME.total_seconds(),
+    )
+    metrics.inc("sessions_renewed")
 
 
 async def require_auth(
-    session_id: Optional[str] = Cookie(None), db: Session = Depends(get_session)
+    response: Response,
+    session_id: Optional[str] = Cookie(None),
+    db: AsyncSession = Depends(get_session),
 ) -> User:
-    user = get_session_user(session_id, db)
-    if not user:
+    cached = await load_session(session_id, db)
+    if cached is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated"
         )
-    return user
+
+    if needs_renewal(cached, datetime.now()):
+        await renew_session(session_id, cached, db)  # pyright: ignore[reportArgumentType]
+        set_session_cookie(response, session_id)  # pyright: ignore[reportArgumentType]
+    return User(**cached.user)
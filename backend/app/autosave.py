@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import update
+from sqlmodel import col, select
+
+from app.changes import NOTE, record_changes
+from app.content import save_contents
+from app.database import session_factory
+from app.metrics import metrics
+from app.models import Note
+
+logger = logging.getLogger(__name__)
+
+# Milliseconds a note update may wait before it is written, 0 writes through.
+# Only for single-worker deployments, see WriteBehindBuffer
+AUTOSAVE_BUFFER_MS = float(os.getenv("AUTOSAVE_BUFFER_MS", "0"))
+# Flush early once this many notes are waiting
+AUTOSAVE_MAX_PENDING = int(os.getenv("AUTOSAVE_MAX_PENDING", "1000"))
+
+
+@dataclass
+class PendingWrite:
+    user_id: int
+    updated_at: datetime
+    # Note columns to set, e.g. title and folder_id
+    fields: Dict[str, Any] = field(default_factory=dict)
+    content: Optional[str] = None
+
+
+class WriteBehindBuffer:
+    """Coalesce note updates in memory and write them in batched transactions
+
+    Only the latest value of each field survives until the flush, so a burst
+    of autosaves to one note costs a single row write. Reads through
+    ``get`` see pending values immediately; other queries see them once the
+    window has passed. The buffer is per process, so read-your-writes and
+    base_version checks only hold for requests served by the same worker;
+    start.sh turns it off when it runs more than one.
+    """
+
+    def __init__(self, window_ms: float, max_pending: int):
+        self.window = window_ms / 1000
+        self.max_pending = max_pending
+        self._pending: Dict[int, PendingWrite] = {}
+        # The batch being written, still visible to readers until it commits
+        self._flushing: Dict[int, PendingWrite] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        metrics.register_gauge("autosave_pending", lambda: len(self._pending))
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def get(self, note_id: int) -> Optional[PendingWrite]:
+        """Unwritten changes to a note, newest values winning"""
+        pending = self._pending.get(note_id)
+        flushing = self._flushing.get(note_id)
+        if pending is None or flushing is None:
+            return pending or flushing
+        return PendingWrite(
+            user_id=pending.user_id,
+            updated_at=pending.updated_at,
+            fields={**flushing.fields, **pending.fields},
+            content=pending.content if pending.content is not None else flushing.content,
+        )
+
+    def put(
+        self,
+        note_id: int,
+        user_id: int,
+        fields: Dict[str, Any],
+        content: Optional[str],
+    ) -> PendingWrite:
+        pending = self._pending.get(note_id)
+        if pending is None:
+            pending = self._pending[note_id] = PendingWrite(user_id, datetime.utcnow())
+        else:
+            # Superseded an update that was never written
+            metrics.inc("autosave_writes_coalesced")
+        pending.updated_at = datetime.utcnow()
+        pending.fields.update(fields)
+        if content is not None:
+            pending.content = content
+        metrics.inc("autosave_writes_buffered")
+        if len(self._pending) >= self.max_pending:
+            self._wake.set()
+        return pending
+
+    def discard(self, note_id: int) -> None:
+        """Forget pending writes for a note that is being deleted"""
+        self._pending.pop(note_id, None)
+        self._flushing.pop(note_id, None)
+
+    async def flush(self) -> int:
+        """Write everything pending in one transaction and return the note count"""
+        async with self._flush_lock:
+            batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            self._flushing = batch
+            try:
+                await self._write(batch)
+            except Exception:
+                metrics.inc("autosave_flush_errors")
+                # Put the batch back without clobbering anything newer
+                for note_id, pending in batch.items():
+                    newer = self._pending.get(note_id)
+                    if newer is not None:
+                        pending.fields.update(newer.fields)
+                        if newer.content is not None:
+                            pending.content = newer.content
+                        pending.updated_at = newer.updated_at
+                    self._pending[note_id] = pending
+                raise
+            finally:
+                self._flushing = {}
+            metrics.inc("autosave_flushes")
+            metrics.inc("autosave_notes_flushed", len(batch))
+            return len(batch)
+
+    async def _write(self, batch: Dict[int, PendingWrite]) -> None:
+        async with session_factory() as session:
+            # Notes deleted while their writes were pending are skipped
+            result = await session.exec(select(Note.id).where(col(Note.id).in_(batch)))
+            existing = set(result.all())
+            writes = {note_id: batch[note_id] for note_id in existing}
+            if not writes:
+                return
+
+            await session.execute(
+                update(Note),
+                [
+                    {"id": note_id, "updated_at": pending.updated_at, **pending.fields}
+                    for note_id, pending in writes.items()
+                ],
+            )
+            await save_contents(
+                session,
+                {
+                    note_id: pending.content
+                    for note_id, pending in writes.items()
+                    if pending.content is not None
+                },
+            )
+            by_user: Dict[int, list] = {}
+            for note_id, pending in writes.items():
+                by_user.setdefault(pending.user_id, []).append(note_id)
+            # Counter rows are locked in user order, so two flushes cannot deadlock
+            for user_id, note_ids in sorted(by_user.items()):
+                await record_changes(session, user_id, NOTE, note_ids)
+            await session.commit()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.window)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Autosave flush failed, retrying next window")
+
+    def start(self) -> None:
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stop the flush loop and write out anything still pending"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+autosave_buffer = WriteBehindBuffer(AUTOSAVE_BUFFER_MS, AUTOSAVE_MAX_PENDING)
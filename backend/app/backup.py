@@ -0,0 +1,170 @@
+"""Online SQLite backups
+
+The database is copied with SQLite's backup API, BACKUP_PAGES_PER_STEP pages
+at a time with a pause of BACKUP_STEP_SLEEP seconds between steps, so the API
+keeps serving while it runs. Each step only holds a read lock, and with WAL
+writers are never blocked by one.
+
+A write through another connection makes SQLite restart the copy at its next
+step. On a database that never goes quiet for long enough, after
+BACKUP_MAX_RESTARTS the rest is copied in one step, which reads a single WAL
+snapshot without blocking writers.
+
+Backups are written next to each other in BACKUP_DIR and the newest
+BACKUP_KEEP are kept. Attachment files (see app.attachments) never change
+once written, so copying ATTACHMENT_DIR afterwards with any file tool is
+enough to back them up too.
+
+    python -m app.backup
+"""
+import fcntl
+import os
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from sqlalchemy.engine import make_url
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "/app/data/backups")
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "1024"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.01"))
+BACKUP_MAX_RESTARTS = int(os.getenv("BACKUP_MAX_RESTARTS", "10"))
+# Completed backups kept in BACKUP_DIR, 0 keeps all of them
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+
+_PREFIX = "notes-"
+_SUFFIX = ".db"
+
+
+class BackupUnavailable(Exception):
+    pass
+
+
+class BackupRunning(Exception):
+    pass
+
+
+class _Restarted(Exception):
+    pass
+
+
+@dataclass
+class BackupProgress:
+    copied: int = 0
+    total: int = 0
+    restarts: int = 0
+
+
+def sqlite_path(url: str) -> str:
+    """The database file behind ``url``, if it is one the backup API can read"""
+    parsed = make_url(url)
+    if not parsed.drivername.startswith("sqlite"):
+        raise BackupUnavailable("Online backups need SQLite, use pg_dump for Postgres")
+    if not parsed.database or parsed.database == ":memory:":
+        raise BackupUnavailable("An in-memory database cannot be backed up")
+    return parsed.database
+
+
+def _copy(
+    source: sqlite3.Connection,
+    target: sqlite3.Connection,
+    progress: BackupProgress,
+    report: Callable[[BackupProgress], None],
+) -> None:
+    def step(status: int, remaining: int, total: int) -> None:
+        copied = total - remaining
+        if copied < progress.copied:
+            progress.restarts += 1
+            if progress.restarts > BACKUP_MAX_RESTARTS:
+                raise _Restarted()
+        progress.copied, progress.total = copied, total
+        report(progress)
+
+    try:
+        source.backup(
+            target, pages=BACKUP_PAGES_PER_STEP, progress=step, sleep=BACKUP_STEP_SLEEP
+        )
+    except _Restarted:
+        source.backup(target, pages=-1)
+        progress.copied = progress.total
+        report(progress)
+
+
+def prune_backups(keep: int = BACKUP_KEEP) -> List[str]:
+    """Delete all but the newest ``keep`` backups and return their paths"""
+    if keep <= 0:
+        return []
+    names = sorted(
+        name for name in os.listdir(BACKUP_DIR)
+        if name.startswith(_PREFIX) and name.endswith(_SUFFIX)
+    )
+    removed = [os.path.join(BACKUP_DIR, name) for name in names[:-keep]]
+    for path in removed:
+        os.unlink(path)
+    return removed
+
+
+def run_backup(
+    database_url: str, report: Optional[Callable[[BackupProgress], None]] = None
+) -> str:
+    """Copy the database into BACKUP_DIR and return the new file's path
+
+    Blocks until the copy is done, so call it from a thread in the server.
+    Raises BackupRunning if another process is already taking a backup.
+    """
+    path = sqlite_path(database_url)
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    with open(os.path.join(BACKUP_DIR, ".lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise BackupRunning("A backup is already running")
+
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        destination = os.path.join(BACKUP_DIR, f"{_PREFIX}{stamp}{_SUFFIX}")
+        partial = destination + ".partial"
+        source = sqlite3.connect(path)
+        target = sqlite3.connect(partial)
+        try:
+            _copy(source, target, BackupProgress(), report or (lambda progress: None))
+            # A self-contained file, restorable without its -wal sidecar
+            target.execute("PRAGMA journal_mode=DELETE")
+        except BaseException:
+            target.close()
+            os.unlink(partial)
+            raise
+        finally:
+            source.close()
+        target.close()
+        os.replace(partial, destination)
+        prune_backups()
+    return destination
+
+
+if __name__ == "__main__":
+    import logging
+    import sys
+    import time
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logger = logging.getLogger(__name__)
+
+    started = time.perf_counter()
+
+    def log_progress(progress: BackupProgress) -> None:
+        logger.info("Copied %d of %d pages", progress.copied, progress.total)
+
+    from app.database import DATABASE_URL
+
+    try:
+        destination = run_backup(DATABASE_URL, log_progress)
+    except (BackupUnavailable, BackupRunning) as e:
+        logger.error("%s", e)
+        sys.exit(1)
+    logger.info(
+        "Backed up to %s in %.2fs", destination, time.perf_counter() - started
+    )
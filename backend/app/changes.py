@@ -0,0 +1,147 @@
+from datetime import datetime
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import func, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.events import queue_changes
+from app.models import ChangeCounter, ChangeLog
+
+NOTE = "note"
+FOLDER = "folder"
+TAG = "tag"
+NOTE_TAG = "note_tag"
+
+
+def change_event(
+    entity: str, entity_id: int, deleted: bool, tag_id: Optional[int] = None
+) -> dict:
+    """What connected clients are told about a change, see app.events"""
+    change = {"entity": entity, "id": entity_id, "deleted": deleted}
+    if tag_id is not None:
+        change["tag_id"] = tag_id
+    return change
+
+
+async def allocate_versions(session: AsyncSession, user_id: int, count: int) -> int:
+    """Reserve ``count`` consecutive change versions and return the first
+
+    Bumping the user's counter row locks it until the transaction ends, so a
+    concurrent writer for the same user waits here and versions become
+    visible in the order they were handed out. A client holding cursor ``v``
+    can therefore never miss a version below ``v`` that commits later.
+    """
+    connection = await session.connection()
+    upsert = postgresql.insert if connection.dialect.name == "postgresql" else sqlite.insert
+    statement = upsert(ChangeCounter).values(user_id=user_id, version=count)
+    statement = statement.on_conflict_do_update(
+        index_elements=[ChangeCounter.user_id],
+        set_={"version": ChangeCounter.version + count},
+    ).returning(ChangeCounter.version)
+    result = await session.execute(statement)
+    return result.scalar_one() - count + 1
+
+
+async def record_change(
+    session: AsyncSession,
+    user_id: int,
+    entity: str,
+    entity_id: int,
+    deleted: bool = False,
+    tag_id: Optional[int] = None,
+) -> None:
+    """Queue a change log entry in the caller's transaction"""
+    session.add(
+        ChangeLog(
+            user_id=user_id,
+            version=await allocate_versions(session, user_id, 1),
+            entity=entity,
+            entity_id=entity_id,
+            tag_id=tag_id,
+            deleted=deleted,
+        )
+    )
+    queue_changes(session, user_id, [change_event(entity, entity_id, deleted, tag_id)])
+
+
+async def record_changes(
+    session: AsyncSession,
+    user_id: int,
+    entity: str,
+    entity_ids: Iterable[int],
+    deleted: bool = False,
+) -> None:
+    """Log many changes to one entity type with a single executemany"""
+    now = datetime.now()
+    rows = [
+        {
+            "user_id": user_id,
+            "entity": entity,
+            "entity_id": entity_id,
+            "deleted": deleted,
+            "created_at": now,
+        }
+        for entity_id in entity_ids
+    ]
+    if rows:
+        first = await allocate_versions(session, user_id, len(rows))
+        for version, row in enumerate(rows, first):
+            row["version"] = version
+        await session.execute(insert(ChangeLog), rows)
+        queue_changes(
+            session,
+            user_id,
+            (change_event(entity, row["entity_id"], deleted) for row in rows),
+        )
+
+
+
+async def record_link_changes(
+    session: AsyncSession,
+    user_id: int,
+    links: Iterable[Tuple[int, int]],
+    deleted: bool = False,
+) -> None:
+    """Log many (note_id, tag_id) link changes with a single executemany"""
+    now = datetime.now()
+    rows = [
+        {
+            "user_id": user_id,
+            "entity": NOTE_TAG,
+            "entity_id": note_id,
+            "tag_id": tag_id,
+            "deleted": deleted,
+            "created_at": now,
+        }
+        for note_id, tag_id in links
+    ]
+    if rows:
+        first = await allocate_versions(session, user_id, len(rows))
+        for version, row in enumerate(rows, first):
+            row["version"] = version
+        await session.execute(insert(ChangeLog), rows)
+        queue_changes(
+            session,
+            user_id,
+            (
+                change_event(NOTE_TAG, row["entity_id"], deleted, row["tag_id"])
+                for row in rows
+            ),
+        )
+
+
+async def current_version(
+    session: AsyncSession, user_id: int, entity: Optional[str] = None
+) -> int:
+    """Latest change version for a user, optionally for one entity type
+
+    Every write goes through the change log, so this moves whenever the user's
+    data does and makes a cheap validator for conditional GETs.
+    """
+    query = select(func.max(ChangeLog.version)).where(ChangeLog.user_id == user_id)
+    if entity is not None:
+        query = query.where(ChangeLog.entity == entity)
+    result = await session.exec(query)
+    return result.one() or 0
@@ -0,0 +1,49 @@
+import os
+import zlib
+from typing import Optional, Tuple
+
+from app.compression import zstandard
+
+# Codec for newly written bodies: none, zlib or zstd. Stored rows record their
+# own encoding, so changing this never breaks reads of existing notes.
+NOTE_CONTENT_COMPRESSION = os.getenv("NOTE_CONTENT_COMPRESSION", "none")
+
+if NOTE_CONTENT_COMPRESSION not in ("none", "zlib", "zstd"):
+    raise RuntimeError(f"Unknown NOTE_CONTENT_COMPRESSION {NOTE_CONTENT_COMPRESSION!r}")
+if NOTE_CONTENT_COMPRESSION == "zstd" and zstandard is None:
+    raise RuntimeError("NOTE_CONTENT_COMPRESSION=zstd needs the zstandard package")
+
+
+def compress(raw: bytes) -> Tuple[str, bytes]:
+    """Return ``(encoding, data)`` for storing ``raw``
+
+    Ciphertext rarely compresses by much, so the compressed form is only kept
+    when it is actually smaller.
+    """
+    if NOTE_CONTENT_COMPRESSION == "zlib":
+        compressed = zlib.compress(raw, 6)
+    elif NOTE_CONTENT_COMPRESSION == "zstd":
+        compressed = zstandard.ZstdCompressor(level=3).compress(raw)  # pyright: ignore[reportOptionalMemberAccess]
+    else:
+        return "identity", raw
+    if len(compressed) < len(raw):
+        return NOTE_CONTENT_COMPRESSION, compressed
+    return "identity", raw
+
+
+def decompress(encoding: Optional[str], data: bytes) -> bytes:
+    if encoding == "zlib":
+        return zlib.decompress(data)
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)  # pyright: ignore[reportOptionalMemberAccess]
+    return bytes(data)
+
+
+def encode_content(content: str) -> Tuple[str, bytes]:
+    return compress(content.encode())
+
+
+def decode_content(encoding: Optional[str], data: Optional[bytes]) -> str:
+    if data is None:
+        return ""
+    return decompress(encoding, data).decode()
@@ -0,0 +1,153 @@
+from typing import Callable, Dict, List, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipResponder, IdentityResponder
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.etag import encoded_etag, etag_candidates
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+class RangeAwareResponder(IdentityResponder):
+    """Keeps range requests and ETags true to the bytes actually sent
+
+    Range offsets refer to the uncompressed bytes, so responses that support
+    byte ranges are sent as they are; compressing a file response would break
+    resumed and partial downloads.
+
+    A compressed body is a different representation, so its strong ETag gets
+    the coding as a suffix (see app.etag). A 304 keeps the suffix the client
+    asked with, so caches match it to the representation they hold.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        requested = etag_candidates(Headers(scope=scope).get("if-none-match"))
+
+        async def send_tagged(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                etag = headers.get("etag")
+                if etag and not etag.startswith("W/"):
+                    encoded = encoded_etag(etag, self.content_encoding)
+                    compressed = (
+                        not self.content_encoding_set
+                        and headers.get("content-encoding") == self.content_encoding
+                    )
+                    if compressed or (message["status"] == 304 and encoded in requested):
+                        headers["etag"] = encoded
+            await send(message)
+
+        await super().__call__(scope, receive, send_tagged)
+
+    async def send_with_compression(self, message: Message) -> None:
+        await super().send_with_compression(message)
+        if message["type"] == "http.response.start":
+            if "accept-ranges" in Headers(raw=message["headers"]):
+                self.content_type_is_excluded = True
+
+
+class RangeAwareGZipResponder(RangeAwareResponder, GZipResponder):
+    pass
+
+
+class BrotliResponder(RangeAwareResponder):
+    content_encoding = "br"
+
+    def __init__(self, app: ASGIApp, minimum_size: int, quality: int) -> None:
+        super().__init__(app, minimum_size)
+        self.compressor = brotli.Compressor(quality=quality)  # pyright: ignore[reportOptionalMemberAccess]
+
+    def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        compressed = self.compressor.process(body)
+        if more_body:
+            return compressed + self.compressor.flush()
+        return compressed + self.compressor.finish()
+
+
+class ZstdResponder(RangeAwareResponder):
+    content_encoding = "zstd"
+
+    def __init__(self, app: ASGIApp, minimum_size: int, level: int) -> None:
+        super().__init__(app, minimum_size)
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()  # pyright: ignore[reportOptionalMemberAccess]
+
+    def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        compressed = self.compressor.compress(body)
+        if more_body:
+            return compressed + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)  # pyright: ignore[reportOptionalMemberAccess]
+        return compressed + self.compressor.flush()
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """Map each coding in an Accept-Encoding header to its q-value"""
+    accepted: Dict[str, float] = {}
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    return accepted
+
+
+class CompressionMiddleware:
+    """Compress responses with the best coding both sides support
+
+    Server preference is zstd, then br, then gzip. Codecs whose packages are not
+    installed are skipped, and bodies under ``minimum_size`` are sent as-is.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1024,
+        gzip_level: int = 6,
+        brotli_quality: int = 4,
+        zstd_level: int = 3,
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.responders: Dict[str, Callable[[], ASGIApp]] = {}
+        if zstandard is not None:
+            self.responders["zstd"] = lambda: ZstdResponder(app, minimum_size, zstd_level)
+        if brotli is not None:
+            self.responders["br"] = lambda: BrotliResponder(app, minimum_size, brotli_quality)
+        self.responders["gzip"] = lambda: RangeAwareGZipResponder(app, minimum_size, gzip_level)
+
+    def choose(self, accept_encoding: str) -> Optional[str]:
+        accepted = parse_accept_encoding(accept_encoding)
+        wildcard = accepted.get("*", 0.0)
+        candidates: List[str] = [
+            coding for coding in self.responders
+            if accepted.get(coding, wildcard) > 0
+        ]
+        if not candidates:
+            return None
+        # Highest q-value wins, server preference breaks ties
+        return max(candidates, key=lambda coding: accepted.get(coding, wildcard))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        coding = self.choose(Headers(scope=scope).get("accept-encoding", ""))
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.responders[coding]()(scope, receive, send)
@@ -0,0 +1,114 @@
+import hashlib
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from sqlalchemy import delete, insert, update
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.codec import decode_content, encode_content
+from app.models import ContentEdit, NoteContent
+from app.revisions import record_revisions
+
+# (encoding, data) exactly as stored in notecontent
+StoredContent = Tuple[str, bytes]
+
+
+def content_version(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+
+def apply_edits(content: str, edits: Sequence[ContentEdit]) -> str:
+    """Apply splice edits whose offsets all refer to the original ``content``"""
+    pieces = []
+    position = 0
+    for edit in edits:
+        if edit.start < position or edit.end < edit.start or edit.end > len(content):
+            raise ValueError(
+                "Edits must be ordered, non-overlapping and within the content"
+            )
+        pieces.append(content[position:edit.start])
+        pieces.append(edit.text)
+        position = edit.end
+    pieces.append(content[position:])
+    return "".join(pieces)
+
+
+def content_row(note_id: int, content: str) -> dict:
+    encoding, data = encode_content(content)
+    return {"note_id": note_id, "encoding": encoding, "data": data}
+
+
+async def save_contents(session: AsyncSession, contents: Dict[int, str]) -> None:
+    """Replace the stored body of each note in ``contents``"""
+    if not contents:
+        return
+    previous = await load_contents(session, contents)
+    await session.execute(
+        delete(NoteContent).where(col(NoteContent.note_id).in_(contents))
+    )
+    await session.execute(
+        insert(NoteContent),
+        [content_row(note_id, content) for note_id, content in contents.items()],
+    )
+    await record_revisions(session, previous, contents)
+
+
+async def load_contents(
+    session: AsyncSession, note_ids: Iterable[int]
+) -> Dict[int, str]:
+    note_ids = list(note_ids)
+    if not note_ids:
+        return {}
+    result = await session.exec(
+        select(NoteContent.note_id, NoteContent.encoding, NoteContent.data)
+        .where(col(NoteContent.note_id).in_(note_ids))
+    )
+    return {
+        note_id: decode_content(encoding, data)
+        for note_id, encoding, data in result.all()
+    }
+
+
+async def load_content(session: AsyncSession, note_id: int) -> str:
+    return (await load_contents(session, [note_id])).get(note_id, "")
+
+
+async def load_stored_content(
+    session: AsyncSession, note_id: int
+) -> Optional[StoredContent]:
+    result = await session.exec(
+        select(NoteContent.encoding, NoteContent.data)
+        .where(NoteContent.note_id == note_id)
+    )
+    row = result.first()
+    return (row[0], row[1]) if row is not None else None
+
+
+async def replace_content(
+    session: AsyncSession,
+    note_id: int,
+    stored: Optional[StoredContent],
+    content: str,
+) -> bool:
+    """Write ``content`` only if the body is still ``stored``
+
+    The comparison happens in the UPDATE itself, so of two writers that read
+    the same body only the first succeeds.
+    """
+    if stored is None:
+        await save_contents(session, {note_id: content})
+        return True
+    row = content_row(note_id, content)
+    result = await session.execute(
+        update(NoteContent)
+        .where(col(NoteContent.note_id) == note_id)
+        .where(col(NoteContent.data) == stored[1])
+        .values(encoding=row["encoding"], data=row["data"]),
+        execution_options={"synchronize_session": False},
+    )
+    if result.rowcount != 1:  # pyright: ignore[reportAttributeAccessIssue]
+        return False
+    await record_revisions(
+        session, {note_id: decode_content(*stored)}, {note_id: content}
+    )
+    return True
@@ -0,0 +1,14 @@
+import os
+from typing import List, Optional
+
+# Origins allowed to make credentialed requests, "*" allows any
+CORS_ORIGINS: List[str] = [
+    origin.strip()
+    for origin in os.getenv("CORS_ORIGINS", "http://localhost:5173").split(",")
+    if origin.strip()
+]
+
+
+def origin_allowed(origin: Optional[str]) -> bool:
+    """Same rule CORSMiddleware applies; requests without an Origin pass"""
+    return origin is None or "*" in CORS_ORIGINS or origin in CORS_ORIGINS
@@ -1,29 +1,128 @@
+import logging
 import os
+import time
+from typing import List
 
-from dotenv import load_dotenv
-from sqlmodel import Session, SQLModel, create_engine  # type: ignore
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-load_dotenv()
-# Get database URL from environment, with proper fallback
+from app.instrumentation import record_query
+from app.metrics import metrics
+from app.migrations import migrate
+
+logger = logging.getLogger(__name__)
+
+# Settings come from the environment only; run uvicorn with --env-file to
+# load a .env file (start.sh does when one exists)
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 # If DATABASE_URL is not set or empty, use default SQLite
 if not DATABASE_URL or DATABASE_URL.strip() == "":
     DATABASE_URL = "sqlite:////app/data/notes.db"
-    print(f"WARNING: DATABASE_URL not set, using default: {DATABASE_URL}")
-else:
-    print(f"Using DATABASE_URL: {DATABASE_URL}")
+    logger.warning("DATABASE_URL not set, using default: %s", DATABASE_URL)
+
+# "development" logs every statement, "production" keeps the engine quiet
+DB_PROFILE = os.getenv("DB_PROFILE", "production")
+
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+IS_SQLITE_MEMORY = IS_SQLITE and (
+    DATABASE_URL in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in DATABASE_URL
+)
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    # Negative values are in KiB
+    "cache_size": os.getenv("SQLITE_CACHE_SIZE", "-65536"),
+    "mmap_size": os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    "busy_timeout": os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"),
+    "foreign_keys": "ON",
+}
+
+
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+
+def async_url(url: str) -> str:
+    """Swap the URL's driver for its asyncio counterpart"""
+    parsed = make_url(url)
+    driver = ASYNC_DRIVERS.get(parsed.drivername, parsed.drivername)
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+
+def engine_options() -> dict:
+    options: dict = {"echo": DB_PROFILE == "development"}
+
+    # Only use check_same_thread for SQLite
+    if IS_SQLITE:
+        options["connect_args"] = {"check_same_thread": False}
+    else:
+        options["pool_pre_ping"] = True
+        options["pool_recycle"] = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+    if not IS_SQLITE_MEMORY:
+        options["pool_size"] = int(os.getenv("DB_POOL_SIZE", "10"))
+        options["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+        options["pool_timeout"] = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+    return options
+
+
+engine = create_async_engine(async_url(DATABASE_URL), **engine_options())
+session_factory = async_sessionmaker(
+    engine, class_=AsyncSession, expire_on_commit=False
+)
+
+
+if IS_SQLITE:
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+
+@event.listens_for(engine.sync_engine, "checkout")
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    metrics.inc("db_pool_checkouts")
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    record_query(time.perf_counter() - conn.info["query_started"].pop())
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def discard_query_timer(exception_context):
+    # Failed statements never reach after_cursor_execute
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_started"):
+        conn.info["query_started"].pop()
 
-# Only use check_same_thread for SQLite
-connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
 
-engine = create_engine(DATABASE_URL, echo=True, connect_args=connect_args)
+if hasattr(engine.pool, "checkedout"):
+    metrics.register_gauge("db_pool_checked_out", engine.pool.checkedout)  # pyright: ignore[reportAttributeAccessIssue]
 
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+async def migrate_database() -> List[int]:
+    """Bring the schema up to date and return the migrations applied"""
+    async with engine.begin() as connection:
+        return await connection.run_sync(migrate)
 
 
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    async with session_factory() as session:
+        # Check the connection out up front so pool waits are measured
+        start = time.perf_counter()
+        await session.connection()
+        metrics.observe("db_pool_wait_seconds", time.perf_counter() - start)
         yield session
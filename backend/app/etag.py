@@ -0,0 +1,59 @@
+import hashlib
+from typing import List, Optional
+
+from fastapi import Response
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def version_etag(*parts: object) -> str:
+    """Strong ETag from the values that fully determine a response"""
+    return make_etag("|".join(str(part) for part in parts).encode())
+
+
+# Content codings the compression middleware may tag ETags with
+CONTENT_CODINGS = ("gzip", "br", "zstd")
+
+
+def encoded_etag(etag: str, coding: str) -> str:
+    """The ETag of ``etag``'s representation after applying ``coding``"""
+    return etag[:-1] + "-" + coding + '"'
+
+
+def identity_etag(etag: str) -> str:
+    """Undo encoded_etag, leaving other tags as they are"""
+    for coding in CONTENT_CODINGS:
+        suffix = "-" + coding + '"'
+        if etag.endswith(suffix):
+            return etag[: -len(suffix)] + '"'
+    return etag
+
+
+def etag_candidates(if_none_match: Optional[str]) -> List[str]:
+    """The tags listed in an If-None-Match header, without W/ prefixes"""
+    if not if_none_match:
+        return []
+    # Weak comparison is what If-None-Match calls for, so ignore W/ prefixes
+    return [value.strip().removeprefix("W/") for value in if_none_match.split(",")]
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Evaluate an If-None-Match header against ``etag``
+
+    Tags of compressed representations match too, since a 304 is answered
+    the same way whichever encoding the client has cached.
+    """
+    candidates = etag_candidates(if_none_match)
+    return "*" in candidates or any(
+        identity_etag(candidate) == etag for candidate in candidates
+    )
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def json_with_etag(body: bytes, etag: str) -> Response:
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
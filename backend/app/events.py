@@ -0,0 +1,271 @@
+import asyncio
+import errno
+import json
+import logging
+import os
+import socket
+from collections import defaultdict
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# local delivers within this process, unix also fans out to the other workers
+# on this host through datagram sockets in EVENTS_SOCKET_DIR
+EVENTS_BROKER = os.getenv("EVENTS_BROKER", "local")
+EVENTS_SOCKET_DIR = os.getenv("EVENTS_SOCKET_DIR", "/tmp/fastnotes-events")
+# Messages a connection may fall behind by before it is dropped
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "64"))
+# Commits touching more rows than this are announced as a single resync
+EVENTS_MAX_CHANGES = int(os.getenv("EVENTS_MAX_CHANGES", "500"))
+
+# Session.info key for changes waiting on the transaction to commit
+PENDING_KEY = "pending_events"
+
+Message = Dict[str, Any]
+
+# Handlers for process-wide notices, see LocalBroker.broadcast
+_notice_handlers: Dict[str, List[Callable[[Any], None]]] = defaultdict(list)
+
+
+def on_notice(kind: str, handler: Callable[[Any], None]) -> None:
+    """Call ``handler(value)`` whenever any worker broadcasts a ``kind`` notice"""
+    _notice_handlers[kind].append(handler)
+
+
+def handle_notice(kind: str, value: Any) -> None:
+    for handler in _notice_handlers.get(kind, ()):
+        try:
+            handler(value)
+        except Exception:
+            logger.exception("Handling %s notice failed", kind)
+
+
+class SlowConsumer(Exception):
+    """The connection fell further behind than its queue allows"""
+
+
+class Subscription:
+    """One connection's bounded queue of messages for a user"""
+
+    def __init__(self, user_id: int, max_queue: int):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self.overflowed = False
+
+    def offer(self, message: Message) -> None:
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Dropping messages would leave the client silently stale, so the
+            # connection is closed instead and the client resyncs on reconnect
+            self.overflowed = True
+            metrics.inc("events_slow_consumers")
+
+    async def next(self, timeout: float) -> Optional[Message]:
+        """The next message, or None if nothing arrived within ``timeout``"""
+        if self.overflowed:
+            raise SlowConsumer()
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LocalBroker:
+    """Fan out change messages to the subscriptions in this process"""
+
+    def __init__(self, max_queue: int = EVENTS_QUEUE_SIZE):
+        self.max_queue = max_queue
+        self._subscribers: Dict[int, Set[Subscription]] = defaultdict(set)
+        metrics.register_gauge("events_connections", self.connections)
+
+    def connections(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(user_id, self.max_queue)
+        self._subscribers[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscribers = self._subscribers.get(subscription.user_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._subscribers[subscription.user_id]
+
+    def publish(self, user_id: int, message: Message) -> None:
+        metrics.inc("events_published")
+        self.deliver(user_id, message)
+
+    def deliver(self, user_id: int, message: Message) -> None:
+        for subscription in list(self._subscribers.get(user_id, ())):
+            subscription.offer(message)
+            metrics.inc("events_delivered")
+
+    def broadcast(self, kind: str, value: Any) -> None:
+        """Tell every worker, this one included, about process-local state to drop"""
+        handle_notice(kind, value)
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class UnixSocketBroker(LocalBroker):
+    """Share messages between the workers on one host
+
+    Every worker binds a datagram socket named after its pid in
+    ``socket_dir`` and sends each message to all the others. Datagrams keep
+    message boundaries and need no connection handling; sockets left behind by
+    dead workers refuse delivery and are removed.
+    """
+
+    def __init__(self, socket_dir: str, max_queue: int = EVENTS_QUEUE_SIZE):
+        super().__init__(max_queue)
+        self.socket_dir = socket_dir
+        self.path = os.path.join(socket_dir, f"{os.getpid()}.sock")
+        self._socket: Optional[socket.socket] = None
+
+    async def start(self) -> None:
+        os.makedirs(self.socket_dir, mode=0o700, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        sock.setblocking(False)
+        self._socket = sock
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._receive)
+
+    async def stop(self) -> None:
+        if self._socket is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._socket.fileno())
+        self._socket.close()
+        self._socket = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def publish(self, user_id: int, message: Message) -> None:
+        super().publish(user_id, message)
+        payload = json.dumps({"user_id": user_id, "message": message}).encode()
+        resync = json.dumps({"user_id": user_id, "message": {"type": "resync"}})
+        self._send(payload, resync.encode())
+
+    def broadcast(self, kind: str, value: Any) -> None:
+        super().broadcast(kind, value)
+        self._send(json.dumps({"notice": kind, "value": value}).encode())
+
+    def _send(self, payload: bytes, fallback: Optional[bytes] = None) -> None:
+        """Send a datagram to every other worker, or ``fallback`` if it is too big"""
+        if self._socket is None:
+            return
+        for peer in self._peers():
+            try:
+                self._socket.sendto(payload, peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Nobody is bound to it any more
+                try:
+                    os.unlink(peer)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                metrics.inc("events_dropped")
+            except OSError as e:
+                if e.errno != errno.EMSGSIZE or fallback is None:
+                    raise
+                self._socket.sendto(fallback, peer)
+
+    def _peers(self) -> List[str]:
+        try:
+            names = os.listdir(self.socket_dir)
+        except FileNotFoundError:
+            return []
+        return [
+            os.path.join(self.socket_dir, name)
+            for name in names
+            if name.endswith(".sock") and os.path.join(self.socket_dir, name) != self.path
+        ]
+
+    def _receive(self) -> None:
+        while self._socket is not None:
+            try:
+                payload = self._socket.recv(65536)
+            except BlockingIOError:
+                return
+            try:
+                data = json.loads(payload)
+                if "notice" in data:
+                    handle_notice(data["notice"], data["value"])
+                else:
+                    self.deliver(int(data["user_id"]), data["message"])
+            except (ValueError, KeyError, TypeError):
+                logger.warning("Discarding malformed event datagram")
+
+
+def make_broker() -> LocalBroker:
+    if EVENTS_BROKER == "local":
+        return LocalBroker()
+    if EVENTS_BROKER == "unix":
+        return UnixSocketBroker(EVENTS_SOCKET_DIR)
+    raise RuntimeError(f"Unknown EVENTS_BROKER {EVENTS_BROKER!r}")
+
+
+_broker: LocalBroker = make_broker()
+
+
+def get_broker() -> LocalBroker:
+    return _broker
+
+
+def set_broker(broker: LocalBroker) -> None:
+    """Swap the broker, e.g. for a test double, before the app starts"""
+    global _broker
+    _broker = broker
+
+
+def queue_changes(session: Any, user_id: int, changes: Iterable[Message]) -> None:
+    """Hold change descriptions until the session's transaction commits"""
+    pending: Dict[int, Optional[List[Message]]] = session.info.setdefault(PENDING_KEY, {})
+    queued = pending.setdefault(user_id, [])
+    if queued is None:
+        return
+    queued.extend(islice(changes, EVENTS_MAX_CHANGES + 1 - len(queued)))
+    if len(queued) > EVENTS_MAX_CHANGES:
+        # Too many to describe, clients fetch them through /sync instead
+        pending[user_id] = None
+
+
+def change_message(changes: Optional[List[Message]]) -> Message:
+    if changes is None:
+        return {"type": "resync"}
+    return {"type": "changes", "changes": changes}
+
+
+@event.listens_for(Session, "after_commit")
+def publish_committed(session: Session) -> None:
+    pending = session.info.pop(PENDING_KEY, None)
+    if not pending:
+        return
+    try:
+        for user_id, changes in pending.items():
+            _broker.publish(user_id, change_message(changes))
+    except Exception:
+        # The data is committed either way; clients catch up through /sync
+        logger.exception("Publishing change events failed")
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_rolled_back(session: Session) -> None:
+    session.info.pop(PENDING_KEY, None)
@@ -0,0 +1,197 @@
+"""Streaming account export
+
+Everything a user owns is read from one snapshot and written out as it is
+fetched, so memory use does not grow with the number or size of notes. Two
+formats carry the same records:
+
+- ``ndjson``: a header line, then one line per folder, tag, note, note/tag
+  link and attachment, each with a ``type`` field.
+- ``zip``: ``manifest.json`` with the header, one ``<type>s.ndjson`` member
+  per record type, and the attachment files under ``attachments/<id>``.
+
+Note bodies are exported as stored, which is ciphertext for encrypted notes.
+"""
+import os
+import zipfile
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+import anyio
+import orjson
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.attachments import blob_path
+from app.changes import current_version
+from app.codec import decode_content
+from app.database import IS_SQLITE, session_factory
+from app.models import Attachment, Folder, Note, NoteContent, NoteTag, Tag
+
+EXPORT_BATCH_SIZE = 500
+EXPORT_FORMAT_VERSION = 1
+# Bytes read from an attachment file at a time
+_FILE_CHUNK_SIZE = 256 * 1024
+
+Record = Dict[str, Any]
+
+
+async def begin_snapshot(session: AsyncSession) -> None:
+    """Make every query in ``session`` read the same state of the database"""
+    if IS_SQLITE:
+        # pysqlite only opens transactions before writes; an explicit one
+        # pins a WAL snapshot until the session closes
+        connection = await session.connection()
+        await connection.exec_driver_sql("BEGIN")
+    else:
+        await session.connection(
+            execution_options={"isolation_level": "REPEATABLE READ"}
+        )
+
+
+def _queries(user_id: int) -> List[Tuple[str, Any]]:
+    folders = (
+        select(Folder.id, Folder.name, Folder.parent_id, Folder.created_at)
+        .where(Folder.user_id == user_id)
+        .order_by(Folder.id)  # pyright: ignore[reportArgumentType]
+    )
+    tags = (
+        select(Tag.id, Tag.name, Tag.parent_id, Tag.created_at)
+        .where(Tag.user_id == user_id)
+        .order_by(Tag.id)  # pyright: ignore[reportArgumentType]
+    )
+    notes = (
+        select(
+            Note.id,
+            Note.title,
+            Note.folder_id,
+            Note.created_at,
+            Note.updated_at,
+            NoteContent.encoding,
+            NoteContent.data,
+        )
+        .outerjoin(NoteContent, NoteContent.note_id == Note.id)  # pyright: ignore[reportArgumentType]
+        .where(Note.user_id == user_id)
+        .order_by(Note.id)  # pyright: ignore[reportArgumentType]
+    )
+    links = (
+        select(NoteTag.note_id, NoteTag.tag_id)
+        .join(Note, Note.id == NoteTag.note_id)  # pyright: ignore[reportArgumentType]
+        .where(Note.user_id == user_id)
+        .order_by(NoteTag.note_id, NoteTag.tag_id)  # pyright: ignore[reportArgumentType]
+    )
+    attachments = (
+        select(
+            Attachment.id,
+            Attachment.note_id,
+            Attachment.filename,
+            Attachment.content_type,
+            Attachment.size,
+            Attachment.digest,
+            Attachment.created_at,
+        )
+        .where(Attachment.user_id == user_id)
+        .order_by(Attachment.id)  # pyright: ignore[reportArgumentType]
+    )
+    return [
+        ("folder", folders),
+        ("tag", tags),
+        ("note", notes),
+        ("note_tag", links),
+        ("attachment", attachments),
+    ]
+
+
+def _record(kind: str, row: Any) -> Record:
+    record = dict(row._mapping)
+    if kind == "note":
+        record["content"] = decode_content(record.pop("encoding"), record.pop("data"))
+    return record
+
+
+async def export_records(user_id: int) -> AsyncIterator[Tuple[str, Record]]:
+    """``(type, record)`` for everything the user owns, header first"""
+    async with session_factory() as session:
+        await begin_snapshot(session)
+        yield "export", {
+            "version": EXPORT_FORMAT_VERSION,
+            "exported_at": datetime.now(),
+            # Sync from here to catch up with changes made after the export
+            "cursor": await current_version(session, user_id),
+        }
+        for kind, query in _queries(user_id):
+            rows = await session.stream(
+                query.execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            async for row in rows:
+                yield kind, _record(kind, row)
+
+
+async def ndjson_export(user_id: int) -> AsyncIterator[bytes]:
+    async for kind, record in export_records(user_id):
+        yield orjson.dumps({"type": kind, **record}) + b"\n"
+
+
+class _Sink:
+    """Write-only file for zipfile that hands back what was written
+
+    Having no ``seek`` makes zipfile stream: sizes and checksums go in data
+    descriptors after each member instead of being patched in afterwards.
+    """
+
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+async def zip_export(user_id: int) -> AsyncIterator[bytes]:
+    sink = _Sink()
+    archive = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED)  # pyright: ignore[reportArgumentType]
+    # Files are added after the records, so only their ids are kept meanwhile
+    files: List[Tuple[int, str]] = []
+    member = None
+    member_kind = None
+    async for kind, record in export_records(user_id):
+        if kind == "export":
+            archive.writestr("manifest.json", orjson.dumps(record))
+            continue
+        if kind != member_kind:
+            if member is not None:
+                member.close()
+            member = archive.open(f"{kind}s.ndjson", "w", force_zip64=True)
+            member_kind = kind
+        member.write(orjson.dumps(record) + b"\n")
+        if kind == "attachment":
+            files.append((record["id"], record["digest"]))
+        if sink.chunks:
+            yield sink.drain()
+    if member is not None:
+        member.close()
+
+    for attachment_id, digest in files:
+        path = blob_path(digest)
+        if not os.path.exists(path):
+            continue
+        info = zipfile.ZipInfo(
+            f"attachments/{attachment_id}", datetime.now().timetuple()[:6]
+        )
+        # Attachments are usually ciphertext or already compressed
+        info.compress_type = zipfile.ZIP_STORED
+        with archive.open(info, "w", force_zip64=True) as member_file:
+            async with await anyio.open_file(path, "rb") as source:
+                while chunk := await source.read(_FILE_CHUNK_SIZE):
+                    member_file.write(chunk)
+                    yield sink.drain()
+
+    archive.close()
+    yield sink.drain()
@@ -0,0 +1,96 @@
+import logging
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+
+@dataclass
+class RequestStats:
+    queries: int = 0
+    db_seconds: float = 0.0
+
+
+# Set for the lifetime of each HTTP request so engine events can attribute
+# queries to it. Shared by reference, so threadpool endpoints count too.
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar(
+    "request_stats", default=None
+)
+
+
+def record_query(elapsed: float) -> None:
+    """Account one executed statement to the process and the current request"""
+    metrics.inc("db_queries")
+    metrics.histogram("db_query_duration_seconds", elapsed)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+
+
+class RequestMetricsMiddleware:
+    """Per-route latency, query count and DB time histograms
+
+    Requests that run more than ``query_threshold`` statements are logged and
+    counted, which is how N+1 query patterns show up.
+    """
+
+    def __init__(self, app: ASGIApp, query_threshold: int = 25) -> None:
+        self.app = app
+        self.query_threshold = query_threshold
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_stats.reset(token)
+            self.record(scope, status_code, elapsed, stats)
+
+    def record(
+        self, scope: Scope, status_code: int, elapsed: float, stats: RequestStats
+    ) -> None:
+        # The route template, not the raw path, keeps label cardinality bounded
+        route = getattr(scope.get("route"), "path", "unmatched")
+        labels = {"method": scope["method"], "route": route}
+
+        metrics.inc("http_requests_total", labels={**labels, "status": str(status_code)})
+        metrics.histogram("http_request_duration_seconds", elapsed, labels)
+        metrics.histogram("http_request_db_seconds", stats.db_seconds, labels)
+        metrics.histogram(
+            "http_request_queries", stats.queries, labels, buckets=QUERY_COUNT_BUCKETS
+        )
+
+        if stats.queries > self.query_threshold:
+            metrics.inc("http_requests_over_query_threshold", labels=labels)
+            logger.warning(
+                "query_threshold_exceeded %s %s: %d queries, %.1fms in database, %.1fms total",
+                scope["method"],
+                route,
+                stats.queries,
+                stats.db_seconds * 1000,
+                elapsed * 1000,
+            )
@@ -1,32 +1,94 @@
+import logging
 import os
+import secrets
+import time
+from typing import Optional
 
-from fastapi import FastAPI  # type: ignore
+from fastapi import FastAPI, Header, HTTPException  # type: ignore
 from fastapi.middleware.cors import CORSMiddleware  # type:ignore
+from fastapi.responses import PlainTextResponse
 
-from app.database import create_db_and_tables
-from app.routes import auth, folders, notes, tags
+from app import IMPORT_STARTED
+from app.attachments import start_sweeper, stop_sweeper
+from app.auth import shutdown_hash_pool
+from app.autosave import autosave_buffer
+from app.compression import CompressionMiddleware
+from app.cors import CORS_ORIGINS
+from app.database import engine, migrate_database
+from app.events import get_broker
+from app.instrumentation import RequestMetricsMiddleware
+from app.metrics import metrics
+from app.reaper import start_reaper, stop_reaper
+from app.routes import admin, attachments, auth, events, export, folders, notes, sync, tags
+
+# uvicorn's own logger, so the startup report shows without logging config
+logger = logging.getLogger("uvicorn.error")
 
 app = FastAPI(title="Notes API")
 
-cors_origins = os.getenv("CORS_ORIGINS", "http://localhost:5173").split(",")
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=cors_origins,
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Sync-Cursor"],
+)
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")),
 )
+# Outermost, so latency includes compression and CORS handling
+app.add_middleware(
+    RequestMetricsMiddleware,
+    query_threshold=int(os.getenv("REQUEST_QUERY_THRESHOLD", "25")),
+)
+
+# Scrapers must send "Authorization: Bearer <token>" when this is set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 
 
 @app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
+async def on_startup():
+    # A worker forked from a process that already used the engine must not
+    # share its pooled connections
+    await engine.dispose(close=False)
+    # Normally a single query: start.sh applies migrations before forking
+    applied = await migrate_database()
+    start_reaper()
+    start_sweeper()
+    autosave_buffer.start()
+    await get_broker().start()
+
+    startup_seconds = time.perf_counter() - IMPORT_STARTED
+    metrics.register_gauge("startup_seconds", lambda: startup_seconds)
+    logger.info(
+        "Worker %d ready in %.2fs%s",
+        os.getpid(),
+        startup_seconds,
+        f" after applying migrations {applied}" if applied else "",
+    )
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Buffered autosaves must reach the database before the process exits
+    await autosave_buffer.stop()
+    await stop_reaper()
+    await stop_sweeper()
+    await get_broker().stop()
+    shutdown_hash_pool()
 
 
 app.include_router(notes.router, prefix="/api")
 app.include_router(folders.router, prefix="/api")
 app.include_router(auth.router, prefix="/api")
 app.include_router(tags.router, prefix="/api")
+app.include_router(sync.router, prefix="/api")
+app.include_router(events.router, prefix="/api")
+app.include_router(attachments.router, prefix="/api")
+app.include_router(export.router, prefix="/api")
+app.include_router(admin.router, prefix="/api")
 
 
 @app.get("/")
@@ -38,3 +100,15 @@ def root():
 def health():
     """Health check endpoint for Docker and Coolify"""
     return {"status": "healthy"}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics(authorization: Optional[str] = Header(None)):
+    """Prometheus scrape endpoint"""
+    expected = f"Bearer {METRICS_TOKEN}"
+    if METRICS_TOKEN and not secrets.compare_digest(authorization or "", expected):
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return PlainTextResponse(
+        metrics.render_prometheus(),
+        media_type="text/plain; version=0.0.4",
+    )
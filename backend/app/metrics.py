@@ -0,0 +1,158 @@
+import bisect
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Seconds, tuned for API requests and individual queries
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    """Cumulative-bucket histogram for one label set"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def _labels(labels: Optional[Dict[str, str]]) -> Labels:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in pairs
+    )
+    return "{" + body + "}"
+
+
+def _format_bound(bound: float) -> str:
+    return str(int(bound)) if float(bound).is_integer() else repr(bound)
+
+
+class Metrics:
+    """Process-wide counters shared by the caches and background workers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._summaries: Set[str] = set()
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._labelled: Dict[str, Dict[Labels, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = defaultdict(dict)
+
+    def inc(
+        self, name: str, value: float = 1, labels: Optional[Dict[str, str]] = None
+    ) -> None:
+        with self._lock:
+            if labels:
+                self._labelled[name][_labels(labels)] += value
+            else:
+                self._counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        """Record a sample as ``<name>_count`` and ``<name>_sum`` counters"""
+        with self._lock:
+            self._summaries.add(name)
+            self._counters[f"{name}_count"] += 1
+            self._counters[f"{name}_sum"] += value
+
+    def histogram(
+        self,
+        name: str,
+        value: float,
+        labels: Optional[Dict[str, str]] = None,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Record a sample in the bucketed histogram for ``labels``"""
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms[name]
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def register_gauge(self, name: str, read: Callable[[], float]) -> None:
+        """Expose a value that is read whenever a snapshot is taken"""
+        self._gauges[name] = read
+
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            values = dict(self._counters)
+        for name, read in self._gauges.items():
+            values[name] = read()
+        return values
+
+    def render_prometheus(self) -> str:
+        """Everything recorded so far in the Prometheus text exposition format"""
+        lines: List[str] = []
+        with self._lock:
+            counters = dict(self._counters)
+            summaries = set(self._summaries)
+            labelled = {name: dict(series) for name, series in self._labelled.items()}
+            histograms = {
+                name: {
+                    key: (hist.buckets, list(hist.counts), hist.sum)
+                    for key, hist in series.items()
+                }
+                for name, series in self._histograms.items()
+            }
+
+        summary_parts = {
+            f"{name}_{part}" for name in summaries for part in ("count", "sum")
+        }
+        for name in sorted(summaries):
+            lines.append(f"# TYPE {name} summary")
+            lines.append(f"{name}_sum {counters.get(f'{name}_sum', 0)}")
+            lines.append(f"{name}_count {counters.get(f'{name}_count', 0)}")
+
+        for name in sorted(set(counters) - summary_parts):
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {counters[name]}")
+
+        for name in sorted(labelled):
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(labelled[name].items()):
+                lines.append(f"{name}{_format_labels(key)} {value}")
+
+        for name in sorted(self._gauges):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {self._gauges[name]()}")
+
+        for name in sorted(histograms):
+            lines.append(f"# TYPE {name} histogram")
+            for key, (buckets, counts, total) in sorted(histograms[name].items()):
+                cumulative = 0
+                for bound, count in zip(buckets, counts):
+                    cumulative += count
+                    le = (("le", _format_bound(bound)),)
+                    lines.append(f"{name}_bucket{_format_labels(key, le)} {cumulative}")
+                cumulative += counts[-1]
+                inf = (("le", "+Inf"),)
+                lines.append(f"{name}_bucket{_format_labels(key, inf)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{name}_count{_format_labels(key)} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
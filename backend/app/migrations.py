@@ -0,0 +1,286 @@
+"""Versioned schema migrations
+
+Each migration runs once per database and is recorded in ``schemaversion``.
+Deployments apply them before starting workers (``python -m app.migrations``,
+see start.sh), so a worker's own check at startup is a single query.
+
+The baseline builds every table of the current models, so on a new database
+later migrations find their work already done and must be written to be
+idempotent (``checkfirst``, column checks and so on).
+"""
+import logging
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import exists, false, func, inspect, insert, literal, select, text, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateTable
+from sqlmodel import SQLModel  # type: ignore
+
+from app.changes import FOLDER, NOTE, NOTE_TAG, TAG
+from app.content import content_row
+from app.models import (
+    Attachment,
+    ChangeCounter,
+    ChangeLog,
+    Folder,
+    Note,
+    NoteContent,
+    NoteRevision,
+    NoteTag,
+    SchemaVersion,
+    Tag,
+)
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_BATCH_SIZE = 1000
+# Key for the Postgres advisory lock held while migrating
+MIGRATION_LOCK_KEY = 0x6E6F746573
+
+
+def create_baseline(connection: Connection) -> None:
+    """Create every table and index that is missing"""
+    SQLModel.metadata.create_all(connection)
+    # create_all skips indexes on tables that already exist. Indexes on columns
+    # that a later migration adds are left to that migration.
+    inspector = inspect(connection)
+    for table in SQLModel.metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if all(column.name in columns for column in index.columns):
+                index.create(connection, checkfirst=True)
+
+
+def move_note_content(connection: Connection) -> None:
+    """Copy bodies from the legacy ``note.content`` column into ``notecontent``"""
+    columns = {column["name"] for column in inspect(connection).get_columns("note")}
+    if "content" not in columns:
+        return
+
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            text(
+                "SELECT id, content FROM note WHERE id > :last_id ORDER BY id LIMIT :limit"
+            ),
+            {"last_id": last_id, "limit": MIGRATION_BATCH_SIZE},
+        ).all()
+        if not rows:
+            break
+        connection.execute(
+            insert(NoteContent),
+            [content_row(note_id, content or "") for note_id, content in rows],
+        )
+        last_id = rows[-1][0]
+
+    connection.execute(text("ALTER TABLE note DROP COLUMN content"))
+
+
+def create_note_revisions(connection: Connection) -> None:
+    NoteRevision.__table__.create(connection, checkfirst=True)  # pyright: ignore[reportAttributeAccessIssue]
+
+
+def create_attachments(connection: Connection) -> None:
+    Attachment.__table__.create(connection, checkfirst=True)  # pyright: ignore[reportAttributeAccessIssue]
+
+
+def find_cycles(parents: Dict[int, Optional[int]]) -> List[int]:
+    """One id from every cycle of parent links, the smallest in its cycle"""
+    state: Dict[int, int] = {}  # 1 while on the current path, 2 once done
+    breaks = []
+    for start in parents:
+        path = []
+        node: Optional[int] = start
+        while node is not None and node in parents and node not in state:
+            state[node] = 1
+            path.append(node)
+            node = parents[node]
+        if node is not None and state.get(node) == 1:
+            cycle = path[path.index(node):]
+            breaks.append(min(cycle))
+        for visited in path:
+            state[visited] = 2
+    return breaks
+
+
+def break_parent_cycles(connection: Connection) -> None:
+    """Detach one member of every folder or tag cycle left by older versions
+
+    Cycles could only come from data written before moves were checked. The
+    detached row becomes a root, so nothing is lost.
+    """
+    for model in (Folder, Tag):
+        rows = connection.execute(select(model.id, model.parent_id)).all()
+        breaks = find_cycles({row_id: parent_id for row_id, parent_id in rows})
+        if breaks:
+            logger.warning(
+                "Detaching %s %s to break parent cycles", model.__tablename__, breaks
+            )
+            connection.execute(
+                update(model).where(model.id.in_(breaks)).values(parent_id=None)  # pyright: ignore[reportAttributeAccessIssue]
+            )
+
+
+def backfill_change_log(connection: Connection) -> None:
+    """Log every folder, tag, note and tag link that has no change log entry
+
+    Rows written before the change log existed were never logged, so a full
+    sync from cursor 0 would not return them.
+    """
+    now = datetime.now()
+    columns = ["user_id", "entity", "entity_id", "tag_id", "deleted", "created_at"]
+    for entity, model in ((FOLDER, Folder), (TAG, Tag), (NOTE, Note)):
+        logged = exists().where(
+            ChangeLog.user_id == model.user_id,
+            ChangeLog.entity == entity,
+            ChangeLog.entity_id == model.id,
+        )
+        rows = (
+            select(
+                model.user_id,
+                literal(entity),
+                model.id,
+                literal(None),
+                false(),
+                literal(now),
+            )
+            .where(~logged)
+            .order_by(model.id)  # pyright: ignore[reportArgumentType]
+        )
+        connection.execute(insert(ChangeLog).from_select(columns, rows))
+
+    logged = exists().where(
+        ChangeLog.user_id == Note.user_id,
+        ChangeLog.entity == NOTE_TAG,
+        ChangeLog.entity_id == NoteTag.note_id,
+        ChangeLog.tag_id == NoteTag.tag_id,
+    )
+    rows = (
+        select(
+            Note.user_id,
+            literal(NOTE_TAG),
+            NoteTag.note_id,
+            NoteTag.tag_id,
+            false(),
+            literal(now),
+        )
+        .join(Note, Note.id == NoteTag.note_id)  # pyright: ignore[reportArgumentType]
+        .where(~logged)
+        .order_by(NoteTag.note_id, NoteTag.tag_id)  # pyright: ignore[reportArgumentType]
+    )
+    connection.execute(insert(ChangeLog).from_select(columns, rows))
+
+
+def version_change_log(connection: Connection) -> None:
+    """Give change log rows per-user versions and seed the counters
+
+    Existing rows keep their id as version, so cursors handed out before
+    this migration stay valid, and each counter resumes from its user's
+    highest id.
+    """
+    columns = {column["name"] for column in inspect(connection).get_columns("changelog")}
+    if "version" not in columns:
+        connection.execute(
+            text("ALTER TABLE changelog ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        )
+    connection.execute(
+        update(ChangeLog).where(ChangeLog.version == 0).values(version=ChangeLog.id)
+    )
+    connection.execute(text("DROP INDEX IF EXISTS ix_changelog_user_id_id"))
+    connection.execute(text("DROP INDEX IF EXISTS ix_changelog_user_entity_id"))
+    for index in ChangeLog.__table__.indexes:  # pyright: ignore[reportAttributeAccessIssue]
+        index.create(connection, checkfirst=True)
+
+    ChangeCounter.__table__.create(connection, checkfirst=True)  # pyright: ignore[reportAttributeAccessIssue]
+    counted = exists().where(ChangeCounter.user_id == ChangeLog.user_id)
+    rows = (
+        select(ChangeLog.user_id, func.max(ChangeLog.version))
+        .where(~counted)
+        .group_by(ChangeLog.user_id)
+    )
+    connection.execute(
+        insert(ChangeCounter).from_select(["user_id", "version"], rows)
+    )
+
+
+# (version, name, apply) in order. Append new migrations, never edit old ones.
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "baseline", create_baseline),
+    (2, "move note content out of row", move_note_content),
+    (3, "note revisions", create_note_revisions),
+    (4, "attachments", create_attachments),
+    (5, "break folder and tag parent cycles", break_parent_cycles),
+    (6, "backfill change log", backfill_change_log),
+    (7, "commit-ordered change versions", version_change_log),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(connection: Connection) -> int:
+    # IF NOT EXISTS rather than checkfirst, which races between workers
+    connection.execute(CreateTable(SchemaVersion.__table__, if_not_exists=True))  # pyright: ignore[reportArgumentType]
+    version = connection.execute(select(func.max(SchemaVersion.version))).scalar()
+    return version or 0
+
+
+def lock_schema(connection: Connection) -> None:
+    """Keep other processes from migrating until this transaction ends"""
+    if connection.dialect.name == "postgresql":
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY}
+        )
+    else:
+        # Any write takes SQLite's database-wide write lock
+        connection.execute(text("UPDATE schemaversion SET version = version"))
+
+
+def migrate(connection: Connection) -> List[int]:
+    """Apply every pending migration in one transaction
+
+    Returns the versions applied, which is empty when the schema was current.
+    """
+    if schema_version(connection) >= LATEST_VERSION:
+        return []
+
+    lock_schema(connection)
+    # Another process may have migrated while we waited for the lock
+    current = schema_version(connection)
+    applied = []
+    for version, name, apply in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info("Applying migration %d: %s", version, name)
+        apply(connection)
+        connection.execute(
+            insert(SchemaVersion).values(
+                version=version, name=name, applied_at=datetime.now()
+            )
+        )
+        applied.append(version)
+    return applied
+
+
+if __name__ == "__main__":
+    import asyncio
+    import time
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    from app.database import engine
+
+    async def main() -> None:
+        started = time.perf_counter()
+        async with engine.begin() as connection:
+            applied = await connection.run_sync(migrate)
+        await engine.dispose()
+        elapsed = time.perf_counter() - started
+        if applied:
+            logger.info("Applied migrations %s in %.2fs", applied, elapsed)
+        else:
+            logger.info("Schema is at version %d, nothing to apply", LATEST_VERSION)
+
+    asyncio.run(main())
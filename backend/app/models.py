@@ -1,6 +1,7 @@
 from datetime import datetime
 from typing import List, Optional
 
+from sqlalchemy import Index
 from sqlmodel import Field, Relationship, SQLModel  # type: ignore
 
 
@@ -23,9 +24,10 @@ class User(SQLModel, table=True):  # type: ignore
 class Session(SQLModel, table=True):  # type: ignore
     id: Optional[int] = Field(default=None, primary_key=True)
     session_id: str = Field(unique=True, index=True)
-    user_id: int = Field(foreign_key="user.id")
+    user_id: int = Field(foreign_key="user.id", index=True)
     created_at: datetime = Field(default_factory=datetime.now)
-    expires_at: datetime
+    # Lets the reaper find expired rows without a table scan
+    expires_at: datetime = Field(index=True)
     ip_address: Optional[str] = None
     user_agent: Optional[str] = None
 
@@ -72,12 +74,17 @@ class Tag(SQLModel, table=True): # type: ignore
 
 
 class Note(SQLModel, table=True):  # type: ignore
+    __table_args__ = (
+        # Keyset pagination over a user's notes, newest first
+        Index("ix_note_user_updated", "user_id", "updated_at", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     title: str = Field(max_length=255)
-    content: str
     folder_id: Optional[int] = Field(default=None, foreign_key="folder.id")
-    created_at: datetime = Field(default_factory=datetime.now)
-    updated_at: datetime = Field(default_factory=datetime.now)
+    # UTC, like the updates in app.routes.notes, so keyset order is by time
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
     user_id: int = Field(foreign_key="user.id")
 
     #Relationships
@@ -87,6 +94,105 @@ class Note(SQLModel, table=True):  # type: ignore
 
 
 
+class NoteContent(SQLModel, table=True):  # type: ignore
+    """Note bodies, kept out of the note row so metadata queries never read them"""
+
+    note_id: int = Field(foreign_key="note.id", primary_key=True, ondelete="CASCADE")
+    # How ``data`` is stored: identity, zlib or zstd (see app.content)
+    encoding: str = Field(default="identity", max_length=16)
+    data: bytes
+
+
+class NoteRevision(SQLModel, table=True):  # type: ignore
+    """Past bodies of a note, stored as reverse deltas (see app.revisions)"""
+
+    note_id: int = Field(foreign_key="note.id", primary_key=True, ondelete="CASCADE")
+    number: int = Field(primary_key=True)
+    created_at: datetime = Field(default_factory=datetime.now)
+    # Last save folded into this revision
+    updated_at: datetime = Field(default_factory=datetime.now)
+    # head, delta or snapshot
+    kind: str = Field(max_length=8)
+    # Length of the revision's body in bytes
+    size: int
+    encoding: str = Field(default="identity", max_length=16)
+    data: Optional[bytes] = None
+
+
+class NoteSearchToken(SQLModel, table=True):  # type: ignore
+    """Client-computed blind keyword tokens (e.g. HMACs) for encrypted notes"""
+
+    __table_args__ = (
+        # Posting lists: every note of a user that contains a token
+        Index("ix_notesearchtoken_user_token", "user_id", "token", "note_id"),
+    )
+
+    note_id: int = Field(foreign_key="note.id", primary_key=True, ondelete="CASCADE")
+    token: str = Field(max_length=128, primary_key=True)
+    user_id: int = Field(foreign_key="user.id")
+
+
+class NoteClientId(SQLModel, table=True):  # type: ignore
+    """Maps client-supplied import ids to notes so bulk imports can be re-run"""
+
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    client_id: str = Field(max_length=255, primary_key=True)
+    note_id: int = Field(foreign_key="note.id", index=True, ondelete="CASCADE")
+
+
+class Attachment(SQLModel, table=True):  # type: ignore
+    """A file attached to a note; the bytes live on disk, see app.attachments"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    note_id: int = Field(foreign_key="note.id", index=True, ondelete="CASCADE")
+    user_id: int = Field(foreign_key="user.id")
+    # SHA-256 of the bytes, which names the file they are stored in
+    digest: str = Field(max_length=64, index=True)
+    size: int
+    filename: str = Field(max_length=255)
+    content_type: str = Field(max_length=255)
+    created_at: datetime = Field(default_factory=datetime.now)
+
+
+class ChangeLog(SQLModel, table=True):  # type: ignore
+    """Append-only record of writes; ``version`` doubles as the sync cursor
+
+    Versions come from the user's ChangeCounter rather than the id, which
+    databases like Postgres assign before commit and so out of commit order.
+    """
+
+    __table_args__ = (
+        Index("ix_changelog_user_version", "user_id", "version"),
+        # Per-entity versions for conditional GETs
+        Index("ix_changelog_user_entity_version", "user_id", "entity", "version"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(foreign_key="user.id")
+    # 0 only on rows logged by migrations before versions were handed out
+    version: int = Field(sa_column_kwargs={"server_default": "0"})
+    entity: str = Field(max_length=16)  # note, folder, tag or note_tag
+    entity_id: int
+    tag_id: Optional[int] = None  # Set for note_tag changes, entity_id is the note
+    deleted: bool = False
+    created_at: datetime = Field(default_factory=datetime.now)
+
+
+class ChangeCounter(SQLModel, table=True):  # type: ignore
+    """Latest change version handed out for each user, see app.changes"""
+
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    version: int = 0
+
+
+class SchemaVersion(SQLModel, table=True):  # type: ignore
+    """One row per migration applied to this database, see app.migrations"""
+
+    version: int = Field(primary_key=True)
+    name: str = Field(max_length=255)
+    applied_at: datetime = Field(default_factory=datetime.now)
+
+
 # API Response models
 class TagRead(SQLModel):
     id: int
@@ -117,14 +223,96 @@ class TagTreeResponse(SQLModel):
     tags: List[TagTreeNode]
 
 
-class NoteRead(SQLModel):
+class NoteSummary(SQLModel):
+    id: int
+    title: str
+    folder_id: Optional[int] = None
+    created_at: datetime
+    updated_at: datetime
+    tags: List[TagRead] = []
+
+
+class NoteRead(NoteSummary):
+    # Left unset by metadata-only listings such as /folders/tree?fields=meta
+    content: Optional[str] = None
+
+
+class NoteDetail(SQLModel):
     id: int
     title: str
     content: str
     folder_id: Optional[int] = None
     created_at: datetime
     updated_at: datetime
+    user_id: int
+    # Hash of ``content``, the base_version for patch updates
+    version: str
+
+
+class NoteVersion(SQLModel):
+    """Body of a PATCH sent with ``Prefer: return=minimal``"""
+
+    id: int
+    version: str
+    updated_at: datetime
+
+
+class RevisionRead(SQLModel):
+    number: int
+    created_at: datetime
+    updated_at: datetime
+    size: int
+    # The revision holding the note's current body
+    current: bool
+
+
+class RevisionDetail(RevisionRead):
+    content: str
+    version: str
+
+
+class AttachmentRead(SQLModel):
+    id: int
+    note_id: int
+    filename: str
+    content_type: str
+    size: int
+    created_at: datetime
+
+
+class NotePage(SQLModel):
+    notes: List[NoteSummary]
+    next_cursor: Optional[str] = None
+
+
+class FolderRead(SQLModel):
+    id: int
+    name: str
+    parent_id: Optional[int] = None
+    created_at: datetime
+
+
+class FolderStats(SQLModel):
+    folder_id: int
+    notes: int
+    subtree_notes: int
+    descendants: int
+
+
+class Tombstone(SQLModel):
+    entity: str
+    id: int
+    tag_id: Optional[int] = None
+
+
+class SyncResponse(SQLModel):
+    cursor: int
+    has_more: bool
+    notes: List[NoteRead] = []
+    folders: List[FolderRead] = []
     tags: List[TagRead] = []
+    note_tags: List[NoteTag] = []
+    deleted: List[Tombstone] = []
 
 
 class FolderTreeNode(SQLModel):
@@ -137,6 +325,8 @@ class FolderTreeNode(SQLModel):
 class FolderTreeResponse(SQLModel):
     folders: List[FolderTreeNode]
     orphaned_notes: List[NoteRead]
+    # Sync cursor the tree is at least as new as; pass it to /sync as ``since``
+    cursor: int
 
 
 # Create/Update models
@@ -144,12 +334,61 @@ class NoteCreate(SQLModel):
     title: str
     content: str
     folder_id: Optional[int] = None
+    # Opt-in blind tokens for /notes/search, never stored on the note itself
+    search_tokens: Optional[List[str]] = None
+
+
+class BulkNoteCreate(NoteCreate):
+    client_id: Optional[str] = Field(default=None, max_length=255)
+    tag_ids: List[int] = []
+
+
+class BulkNoteRequest(SQLModel):
+    notes: List[BulkNoteCreate]
+    # Update notes whose client_id was seen before instead of rejecting them
+    upsert: bool = False
+
+
+class BulkNoteResponse(SQLModel):
+    ids: List[int]
+
+
+class NoteTagsUpdate(SQLModel):
+    tag_ids: List[int]
+
+
+class TagLink(SQLModel):
+    note_id: int
+    tag_id: int
+
+
+class TagAssignRequest(SQLModel):
+    links: List[TagLink]
+
+
+class TagAssignResponse(SQLModel):
+    added: int
+
+
+class ContentEdit(SQLModel):
+    """Replace ``content[start:end]`` of the base version with ``text``"""
+
+    start: int = Field(ge=0)
+    end: int = Field(ge=0)
+    text: str = ""
 
 
 class NoteUpdate(SQLModel):
     title: Optional[str] = None
     content: Optional[str] = None
     folder_id: Optional[int] = None
+    # Replaces the note's search tokens when set
+    search_tokens: Optional[List[str]] = None
+    # Version the edits (or the new content) were made against. The update is
+    # rejected with 409 if the note has changed since.
+    base_version: Optional[str] = None
+    # Ordered, non-overlapping edits with offsets into the base version
+    edits: Optional[List[ContentEdit]] = None
 
 
 class FolderCreate(SQLModel):
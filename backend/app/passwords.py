@@ -0,0 +1,33 @@
+"""bcrypt helpers run inside the password hashing worker processes.
+
+Kept free of app imports so spawned workers stay cheap to start.
+"""
+import time
+from typing import Any, Callable, Tuple
+
+import bcrypt
+
+
+def hash_password(password: str, rounds: int) -> str:
+    password_bytes = password.encode("utf-8")
+    salt = bcrypt.gensalt(rounds=rounds)
+    hashed = bcrypt.hashpw(password_bytes, salt)
+    return hashed.decode("utf-8")
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    password_bytes = plain_password.encode("utf-8")
+    hashed_bytes = hashed_password.encode("utf-8")
+    return bcrypt.checkpw(password_bytes, hashed_bytes)
+
+
+def hash_rounds(hashed_password: str) -> int:
+    # bcrypt hashes look like $2b$<rounds>$<salt+hash>
+    return int(hashed_password.split("$")[2])
+
+
+def timed(fn: Callable[..., Any], *args: Any) -> Tuple[Any, float, float]:
+    """Run ``fn`` and return its result, wall-clock start time and duration"""
+    started = time.time()
+    result = fn(*args)
+    return result, started, time.time() - started
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import delete
+from sqlmodel import col, select
+
+from app.database import session_factory
+from app.metrics import metrics
+from app.models import Session as SessionModel
+
+logger = logging.getLogger(__name__)
+
+# Seconds between sweeps, 0 disables the reaper
+SESSION_REAP_INTERVAL = float(os.getenv("SESSION_REAP_INTERVAL", "3600"))
+# Rows deleted per transaction so a large backlog never holds a long write lock
+SESSION_REAP_BATCH_SIZE = int(os.getenv("SESSION_REAP_BATCH_SIZE", "1000"))
+
+_reaper_task: Optional[asyncio.Task] = None
+
+
+async def reap_expired_sessions(batch_size: int = SESSION_REAP_BATCH_SIZE) -> int:
+    """Delete every session that has expired, one bounded batch at a time"""
+    now = datetime.now()
+    total = 0
+    while True:
+        expired = (
+            select(SessionModel.id)
+            .where(SessionModel.expires_at < now)
+            .limit(batch_size)
+        )
+        async with session_factory() as session:
+            result = await session.execute(
+                delete(SessionModel).where(col(SessionModel.id).in_(expired)),
+                execution_options={"synchronize_session": False},
+            )
+            await session.commit()
+
+        reaped = result.rowcount  # pyright: ignore[reportAttributeAccessIssue]
+        total += reaped
+        metrics.inc("sessions_reaped", reaped)
+        if reaped < batch_size:
+            break
+        # Let requests waiting on the database in between batches
+        await asyncio.sleep(0)
+
+    metrics.inc("session_reaper_runs")
+    return total
+
+
+async def run_reaper(interval: float) -> None:
+    while True:
+        try:
+            await reap_expired_sessions()
+        except Exception:
+            metrics.inc("session_reaper_errors")
+            logger.exception("Expired session sweep failed")
+        await asyncio.sleep(interval)
+
+
+def start_reaper() -> None:
+    global _reaper_task
+    if SESSION_REAP_INTERVAL > 0 and _reaper_task is None:
+        _reaper_task = asyncio.create_task(run_reaper(SESSION_REAP_INTERVAL))
+
+
+async def stop_reaper() -> None:
+    global _reaper_task
+    if _reaper_task is not None:
+        _reaper_task.cancel()
+        try:
+            await _reaper_task
+        except asyncio.CancelledError:
+            pass
+        _reaper_task = None
@@ -0,0 +1,21 @@
+from typing import Any, Mapping, Optional, Sequence, Union
+
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+
+def orjson_response(
+    content: Union[BaseModel, Sequence[BaseModel]],
+    headers: Optional[Mapping[str, str]] = None,
+    **dump_options: Any,
+) -> ORJSONResponse:
+    """Render response models with orjson
+
+    Returning a Response skips FastAPI's dump/validate/dump round trip through
+    the response_model, which dominates serialization time on large payloads.
+    """
+    if isinstance(content, BaseModel):
+        data = content.model_dump(mode="json", **dump_options)
+    else:
+        data = [item.model_dump(mode="json", **dump_options) for item in content]
+    return ORJSONResponse(data, headers=headers)
@@ -0,0 +1,290 @@
+"""Note body history
+
+Revisions of a note are numbered from 1. The newest is the ``head`` and
+stores nothing: its body is the current one in ``notecontent``. Older
+revisions store how to get from the next newer revision back to them as a
+reverse ``delta``, or as a full ``snapshot`` when a delta would not be
+smaller or the chain of deltas would grow past REVISION_MAX_CHAIN. A save
+only needs the body it replaces and the new one, and any revision is
+rebuilt from at most REVISION_MAX_CHAIN deltas.
+
+Saves that arrive within REVISION_WINDOW seconds of the head's first save
+are folded into it, so autosaves do not create a revision each. The delta
+below the head is then re-encoded against the new body.
+"""
+import os
+import struct
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, insert, tuple_, update
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.codec import compress, decode_content, decompress
+from app.models import NoteContent, NoteRevision, RevisionRead
+
+# Saves within this many seconds of the head's first save join that revision
+REVISION_WINDOW = float(os.getenv("REVISION_WINDOW", "300"))
+# Most deltas between snapshots, which bounds the cost of rebuilding a revision
+REVISION_MAX_CHAIN = int(os.getenv("REVISION_MAX_CHAIN", "16"))
+
+HEAD = "head"
+DELTA = "delta"
+SNAPSHOT = "snapshot"
+
+# Delta header: where the changed range starts and how many bytes it replaces
+_SPLICE = struct.Struct("<II")
+
+
+def _common_prefix(a: bytes, b: bytes) -> int:
+    # Bisection over slice comparisons keeps the byte work in memcmp
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _common_suffix(a: bytes, b: bytes, limit: int) -> int:
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:] == b[len(b) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def make_delta(base: bytes, target: bytes) -> bytes:
+    """Encode ``target`` as one splice into ``base``
+
+    Everything outside the range that differs is shared, so the delta is as
+    large as the edited region rather than the body.
+    """
+    start = _common_prefix(base, target)
+    end = _common_suffix(base, target, min(len(base), len(target)) - start)
+    removed = len(base) - end - start
+    return _SPLICE.pack(start, removed) + target[start:len(target) - end]
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    start, removed = _SPLICE.unpack_from(delta)
+    return base[:start] + delta[_SPLICE.size:] + base[start + removed:]
+
+
+async def record_revisions(
+    session: AsyncSession,
+    previous: Dict[int, str],
+    contents: Dict[int, str],
+) -> None:
+    """Account for new bodies in each note's history
+
+    ``previous`` holds the bodies being replaced; notes missing from it are
+    new. Call in the same transaction that writes ``contents``.
+    """
+    changed = {
+        note_id: content
+        for note_id, content in contents.items()
+        if previous.get(note_id) != content
+    }
+    if not changed:
+        return
+
+    now = datetime.now()
+    result = await session.exec(
+        select(NoteRevision.note_id, NoteRevision.number, NoteRevision.created_at)
+        .where(col(NoteRevision.note_id).in_(changed))
+        .where(NoteRevision.kind == HEAD)
+    )
+    heads = {note_id: (number, created_at) for note_id, number, created_at in result.all()}
+    result = await session.exec(
+        select(NoteRevision.note_id, func.max(NoteRevision.number))
+        .where(col(NoteRevision.note_id).in_(heads))
+        .where(NoteRevision.kind == SNAPSHOT)
+        .group_by(col(NoteRevision.note_id))
+    )
+    snapshots = dict(result.all())
+
+    window_start = now - timedelta(seconds=REVISION_WINDOW)
+    new_rows = []
+    # Primary key plus new values, sent as one bulk UPDATE by primary key
+    head_updates = []
+    # Note id -> revision before a head whose body changed in place
+    folded: Dict[int, int] = {}
+    for note_id, content in changed.items():
+        body = content.encode()
+        head = heads.get(note_id)
+        if head is None:
+            number = 1
+            if note_id in previous:
+                # History starts with the body the note had before tracking
+                old = previous[note_id].encode()
+                encoding, data = compress(old)
+                new_rows.append(_row(note_id, 1, now, SNAPSHOT, len(old), encoding, data))
+                number = 2
+            new_rows.append(_row(note_id, number, now, HEAD, len(body)))
+            continue
+
+        number, created_at = head
+        if created_at > window_start:
+            head_updates.append(
+                {"note_id": note_id, "number": number, "updated_at": now, "size": len(body)}
+            )
+            if number > 1:
+                folded[note_id] = number - 1
+            continue
+
+        # Retire the head: store how to get back to it from the new body
+        old = previous.get(note_id, "").encode()
+        delta = make_delta(body, old)
+        kind = DELTA
+        # Revisions down to the last snapshot are rebuilt through this one
+        chain = number - snapshots.get(note_id, 0)
+        if chain > REVISION_MAX_CHAIN or len(delta) >= len(old):
+            kind, stored = SNAPSHOT, old
+        else:
+            stored = delta
+        encoding, data = compress(stored)
+        head_updates.append({
+            "note_id": note_id,
+            "number": number,
+            "kind": kind,
+            "encoding": encoding,
+            "data": data,
+        })
+        new_rows.append(_row(note_id, number + 1, now, HEAD, len(body)))
+
+    if folded:
+        head_updates.extend(await _rebase_deltas(session, folded, previous, changed))
+    if head_updates:
+        # SQLAlchemy groups the rows by the columns they set, one executemany each
+        await session.execute(update(NoteRevision), head_updates)
+    if new_rows:
+        await session.execute(insert(NoteRevision), new_rows)
+
+
+async def _rebase_deltas(
+    session: AsyncSession,
+    folded: Dict[int, int],
+    previous: Dict[int, str],
+    changed: Dict[int, str],
+) -> List[dict]:
+    """Re-encode the deltas that pointed at a head's body before it was folded
+
+    A delta is taken against the next newer revision's body, and a folded
+    save replaces the head's. Updates are shaped like a retired head's.
+    """
+    result = await session.exec(
+        select(
+            NoteRevision.note_id,
+            NoteRevision.number,
+            NoteRevision.encoding,
+            NoteRevision.data,
+        )
+        .where(tuple_(NoteRevision.note_id, NoteRevision.number).in_(folded.items()))
+        .where(NoteRevision.kind == DELTA)
+    )
+    updates = []
+    for note_id, number, encoding, data in result.all():
+        body = changed[note_id].encode()
+        base = previous.get(note_id, "").encode()
+        old = apply_delta(base, decompress(encoding, data))  # pyright: ignore[reportArgumentType]
+        delta = make_delta(body, old)
+        kind, stored = (SNAPSHOT, old) if len(delta) >= len(old) else (DELTA, delta)
+        encoding, data = compress(stored)
+        updates.append({
+            "note_id": note_id,
+            "number": number,
+            "kind": kind,
+            "encoding": encoding,
+            "data": data,
+        })
+    return updates
+
+
+def _row(
+    note_id: int,
+    number: int,
+    now: datetime,
+    kind: str,
+    size: int,
+    encoding: str = "identity",
+    data: Optional[bytes] = None,
+) -> dict:
+    return {
+        "note_id": note_id,
+        "number": number,
+        "created_at": now,
+        "updated_at": now,
+        "kind": kind,
+        "size": size,
+        "encoding": encoding,
+        "data": data,
+    }
+
+
+async def list_revisions(session: AsyncSession, note_id: int) -> List[RevisionRead]:
+    """Newest first, without reading any stored bodies"""
+    result = await session.exec(
+        select(
+            NoteRevision.number,
+            NoteRevision.created_at,
+            NoteRevision.updated_at,
+            NoteRevision.size,
+            NoteRevision.kind,
+        )
+        .where(NoteRevision.note_id == note_id)
+        .order_by(col(NoteRevision.number).desc())
+    )
+    return [
+        RevisionRead(
+            number=number,
+            created_at=created_at,
+            updated_at=updated_at,
+            size=size,
+            current=kind == HEAD,
+        )
+        for number, created_at, updated_at, size, kind in result.all()
+    ]
+
+
+async def load_revision(
+    session: AsyncSession, note_id: int, number: int
+) -> Optional[Tuple[NoteRevision, str]]:
+    """A revision and its body, rebuilt from the nearest newer snapshot or head"""
+    anchor = (
+        select(func.min(NoteRevision.number))
+        .where(NoteRevision.note_id == note_id)
+        .where(NoteRevision.number >= number)
+        .where(NoteRevision.kind != DELTA)
+        .scalar_subquery()
+    )
+    result = await session.exec(
+        select(NoteRevision)
+        .where(NoteRevision.note_id == note_id)
+        .where(col(NoteRevision.number) >= number)
+        .where(col(NoteRevision.number) <= anchor)
+        .order_by(col(NoteRevision.number).desc())
+    )
+    chain = list(result.all())
+    if not chain or chain[-1].number != number:
+        return None
+
+    top = chain[0]
+    if top.kind == HEAD:
+        result = await session.exec(
+            select(NoteContent.encoding, NoteContent.data)
+            .where(NoteContent.note_id == note_id)
+        )
+        row = result.first()
+        body = decode_content(*row).encode() if row is not None else b""
+    else:
+        body = decompress(top.encoding, top.data)  # pyright: ignore[reportArgumentType]
+    for revision in chain[1:]:
+        body = apply_delta(body, decompress(revision.encoding, revision.data))  # pyright: ignore[reportArgumentType]
+    return chain[-1], body.decode()
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+import secrets
+from typing import Optional
+
+import anyio
+import orjson
+from app.backup import (
+    BackupProgress,
+    BackupRunning,
+    BackupUnavailable,
+    run_backup,
+    sqlite_path,
+)
+from app.database import DATABASE_URL
+from app.metrics import metrics
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import StreamingResponse
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+logger = logging.getLogger(__name__)
+
+# Operators send "Authorization: Bearer <token>"; unset disables these routes
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Seconds between progress lines while a backup runs
+BACKUP_PROGRESS_INTERVAL = 1.0
+
+# Backups keep running if the client that started them goes away
+_backup_tasks: "set[asyncio.Task]" = set()
+
+
+def require_admin(authorization: Optional[str] = Header(None)) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled")
+    if not secrets.compare_digest(authorization or "", f"Bearer {ADMIN_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+
+def backup_finished(task: asyncio.Task) -> None:
+    _backup_tasks.discard(task)
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is None:
+        metrics.inc("backups_taken")
+    elif not isinstance(error, BackupRunning):
+        metrics.inc("backup_errors")
+        logger.error("Backup failed", exc_info=error)
+
+
+def progress_line(kind: str, **fields) -> bytes:
+    return orjson.dumps({"type": kind, **fields}) + b"\n"
+
+
+@router.post("/backup", dependencies=[Depends(require_admin)])
+async def backup_database():
+    """Take an online backup of the SQLite database
+
+    Streams NDJSON: ``progress`` lines with pages copied and total, then one
+    ``done`` line with the backup's path and size, or an ``error`` line. A
+    409 means a backup is already running in some worker.
+    """
+    try:
+        sqlite_path(DATABASE_URL)
+    except BackupUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+
+    progress = BackupProgress()
+
+    def report(latest: BackupProgress) -> None:
+        progress.copied, progress.total = latest.copied, latest.total
+        progress.restarts = latest.restarts
+
+    task = asyncio.create_task(anyio.to_thread.run_sync(run_backup, DATABASE_URL, report))
+    _backup_tasks.add(task)
+    task.add_done_callback(backup_finished)
+    # Give the lock a moment so a concurrent backup is a 409, not a stream
+    await asyncio.wait({task}, timeout=0.05)
+    if task.done() and isinstance(task.exception(), BackupRunning):
+        raise HTTPException(status_code=409, detail="A backup is already running")
+
+    async def stream():
+        while True:
+            await asyncio.wait({task}, timeout=BACKUP_PROGRESS_INTERVAL)
+            if not task.done():
+                yield progress_line(
+                    "progress", copied=progress.copied, total=progress.total
+                )
+                continue
+            if task.exception() is not None:
+                yield progress_line("error", detail=str(task.exception()))
+            else:
+                path = task.result()
+                yield progress_line(
+                    "done", path=path, bytes=os.path.getsize(path),
+                    pages=progress.total, restarts=progress.restarts,
+                )
+            return
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
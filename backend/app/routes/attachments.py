@@ -0,0 +1,157 @@
+from typing import List, Optional
+
+from app.attachments import (
+    ATTACHMENT_MAX_BYTES,
+    UploadTooLarge,
+    blob_path,
+    stat_blob,
+    store_stream,
+)
+from app.auth import get_session_user, require_auth
+from app.database import get_session, session_factory
+from app.etag import etag_matches, not_modified, version_etag
+from app.models import Attachment, AttachmentRead, Note, User
+from fastapi import APIRouter, Cookie, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import FileResponse
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+router = APIRouter(prefix="/attachments", tags=["attachments"])
+
+# Stored bytes never change for a given id
+CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+async def transfer_user(session_id: Optional[str] = Cookie(None)) -> User:
+    """Authenticate without keeping a connection for the whole transfer
+
+    Uploads and downloads can take minutes, and require_auth's session would
+    hold a pooled connection until the response finishes.
+    """
+    async with session_factory() as db:
+        user = await get_session_user(session_id, db)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return user
+
+
+async def require_note(session: AsyncSession, note_id: int, user_id: int) -> None:
+    result = await session.exec(
+        select(Note.id).where(Note.id == note_id).where(Note.user_id == user_id)
+    )
+    if result.first() is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+
+
+@router.post("", response_model=AttachmentRead, status_code=201)
+async def upload_attachment(
+    request: Request,
+    note_id: int = Query(...),
+    filename: str = Query(..., min_length=1, max_length=255),
+    content_type: str = Header("application/octet-stream", max_length=255),
+    content_length: Optional[int] = Header(None),
+    current_user: User = Depends(transfer_user),
+):
+    """Attach the raw request body to a note
+
+    The body is streamed to disk as it arrives, so files of any size up to
+    ATTACHMENT_MAX_BYTES use constant memory. Notes refer to the returned id.
+    """
+    if content_length is not None and content_length > ATTACHMENT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Attachment too large")
+    async with session_factory() as session:
+        await require_note(session, note_id, current_user.id)  # pyright: ignore[reportArgumentType]
+
+    try:
+        digest, size = await store_stream(request.stream())
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="Attachment too large")
+
+    attachment = Attachment(
+        note_id=note_id,
+        user_id=current_user.id,  # pyright: ignore[reportArgumentType]
+        digest=digest,
+        size=size,
+        filename=filename,
+        content_type=content_type,
+    )
+    async with session_factory() as session:
+        # The note may have been deleted while the body was uploading
+        await require_note(session, note_id, current_user.id)  # pyright: ignore[reportArgumentType]
+        session.add(attachment)
+        await session.commit()
+    return attachment
+
+
+@router.get("", response_model=List[AttachmentRead])
+async def list_attachments(
+    note_id: int = Query(...),
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    await require_note(session, note_id, current_user.id)  # pyright: ignore[reportArgumentType]
+    attachments = await session.exec(
+        select(Attachment)
+        .where(Attachment.note_id == note_id)
+        .order_by(Attachment.id)  # pyright: ignore[reportArgumentType]
+    )
+    return attachments.all()
+
+
+@router.get("/{attachment_id}")
+async def download_attachment(
+    attachment_id: int,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(transfer_user),
+):
+    """Send the attachment's bytes, honouring Range and If-Range requests"""
+    async with session_factory() as session:
+        result = await session.exec(
+            select(Attachment)
+            .where(Attachment.id == attachment_id)
+            .where(Attachment.user_id == current_user.id)
+        )
+        attachment = result.first()
+    if attachment is None:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+    etag = version_etag("attachment", attachment.digest)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    stat = await stat_blob(attachment.digest)
+    if stat is None:
+        raise HTTPException(status_code=404, detail="Attachment data missing")
+
+    # FileResponse streams straight from the file and answers Range itself;
+    # the compression middleware leaves ranged responses alone
+    return FileResponse(
+        blob_path(attachment.digest),
+        media_type=attachment.content_type,
+        filename=attachment.filename,
+        stat_result=stat,
+        headers={
+            "ETag": etag,
+            "Cache-Control": CACHE_CONTROL,
+            "X-Content-Type-Options": "nosniff",
+        },
+    )
+
+
+@router.delete("/{attachment_id}")
+async def delete_attachment(
+    attachment_id: int,
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    """Detach the file; its bytes go once no attachment refers to them"""
+    result = await session.exec(
+        select(Attachment)
+        .where(Attachment.id == attachment_id)
+        .where(Attachment.user_id == current_user.id)
+    )
+    attachment = result.first()
+    if attachment is None:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    await session.delete(attachment)
+    await session.commit()
+    return {"message": "Attachment deleted"}
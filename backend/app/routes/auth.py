@@ -1,12 +1,21 @@
 from datetime import datetime
 from typing import Optional
 
-from app.auth import create_session, hash_password, require_auth, verify_password
+from app.auth import (
+    create_session,
+    hash_password,
+    invalidate_session,
+    needs_rehash,
+    require_auth,
+    set_session_cookie,
+    verify_password,
+)
 from app.database import get_session
 from app.models import Session as SessionModel
 from app.models import User
 from fastapi import APIRouter, Cookie, Depends, HTTPException, Request, Response
-from sqlmodel import Session, SQLModel, select
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
@@ -34,18 +43,19 @@ class UserResponse(SQLModel):
 
 
 @router.post("/register")
-def register(
+async def register(
     data: RegisterRequest,
     request: Request,
     response: Response,
-    db: Session = Depends(get_session),
+    db: AsyncSession = Depends(get_session),
 ):
     # Check existing user
-    existing = db.exec(
+    result = await db.exec(
         select(User).where(
             (User.username == data.username) | (User.email == data.email)
         )
-    ).first()
+    )
+    existing = result.first()
 
     if existing:
         raise HTTPException(status_code=400, detail="User already exists")
@@ -54,75 +64,71 @@ def register(
     user = User(
         username=data.username,
         email=data.email,
-        hashed_password=hash_password(data.password),
+        hashed_password=await hash_password(data.password),
         salt=data.salt,
         wrapped_master_key=data.wrappedMasterKey,
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
 
     # Create session
     assert user.id is not None
-    session_id = create_session(user.id, request, db)
+    session_id = await create_session(user.id, request, db)
 
     # Set cookie
-    response.set_cookie(
-        key="session_id",
-        value=session_id,
-        httponly=True,
-        secure=True,
-        samesite="lax",
-        max_age=30 * 24 * 60 * 60,  # 30 days
-    )
+    set_session_cookie(response, session_id)
 
     return {"user": UserResponse.model_validate(user)}
 
 
 @router.post("/login")
-def login(
+async def login(
     data: LoginRequest,
     request: Request,
     response: Response,
-    db: Session = Depends(get_session),
+    db: AsyncSession = Depends(get_session),
 ):
     # Find user
-    user = db.exec(select(User).where(User.username == data.username)).first()
+    result = await db.exec(select(User).where(User.username == data.username))
+    user = result.first()
 
-    if not user or not verify_password(data.password, user.hashed_password):
+    if not user or not await verify_password(data.password, user.hashed_password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
+    # Upgrade hashes made with an older work factor while we have the password
+    if needs_rehash(user.hashed_password):
+        user.hashed_password = await hash_password(data.password)
+        db.add(user)
+
     # Create session
     assert user.id is not None
-    session_id = create_session(user.id, request, db)
+    session_id = await create_session(user.id, request, db)
 
     # Set cookie
-    response.set_cookie(
-        key="session_id",
-        value=session_id,
-        httponly=True,
-        secure=True,
-        samesite="lax",
-        max_age=30 * 24 * 60 * 60,
-    )
+    set_session_cookie(response, session_id)
 
     return {"user": UserResponse.model_validate(user)}
 
 
 @router.post("/logout")
-def logout(
+async def logout(
     response: Response,
     session_id: Optional[str] = Cookie(None),
-    db: Session = Depends(get_session),
+    db: AsyncSession = Depends(get_session),
 ):
     # Delete session from database
     if session_id:
-        session = db.exec(
+        result = await db.exec(
             select(SessionModel).where(SessionModel.session_id == session_id)
-        ).first()
+        )
+        session = result.first()
         if session:
-            db.delete(session)
-            db.commit()
+            await db.delete(session)
+            await db.commit()
+        # Only once the row is gone, or a request racing the commit could
+        # load the session back into the cache
+        invalidate_session(session_id)
 
     # Clear cookie
     response.delete_cookie("session_id")
@@ -130,36 +136,39 @@ def logout(
 
 
 @router.get("/me")
-def get_current_user(current_user: User = Depends(require_auth)):
+async def get_current_user(current_user: User = Depends(require_auth)):
     return {"user": UserResponse.from_orm(current_user)}
 
 
 @router.get("/sessions")
-def list_sessions(
-    current_user: User = Depends(require_auth), db: Session = Depends(get_session)
+async def list_sessions(
+    current_user: User = Depends(require_auth),
+    db: AsyncSession = Depends(get_session),
 ):
-    sessions = db.exec(
+    result = await db.exec(
         select(SessionModel)
         .where(SessionModel.user_id == current_user.id)
         .where(SessionModel.expires_at > datetime.utcnow())
-    ).all()
-    return {"sessions": sessions}
+    )
+    return {"sessions": result.all()}
 
 
 @router.delete("/sessions/{session_token}")
-def revoke_session(
+async def revoke_session(
     session_token: str,
     current_user: User = Depends(require_auth),
-    db: Session = Depends(get_session),
+    db: AsyncSession = Depends(get_session),
 ):
-    session = db.exec(
+    result = await db.exec(
         select(SessionModel)
         .where(SessionModel.session_id == session_token)
         .where(SessionModel.user_id == current_user.id)
-    ).first()
+    )
+    session = result.first()
 
     if session:
-        db.delete(session)
-        db.commit()
+        await db.delete(session)
+        await db.commit()
+        invalidate_session(session_token)
 
     return {"message": "Session revoked"}
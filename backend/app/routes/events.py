@@ -0,0 +1,162 @@
+import json
+import os
+from typing import Optional
+
+import anyio
+from app.auth import get_session_user
+from app.changes import current_version
+from app.cors import origin_allowed
+from app.database import session_factory
+from app.events import SlowConsumer, Subscription, get_broker
+from fastapi import APIRouter, Cookie, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+
+router = APIRouter(prefix="/events", tags=["events"])
+
+# Seconds between keep-alives, which is also how often the session is rechecked
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "30"))
+
+# WebSocket close codes
+POLICY_VIOLATION = 1008
+TRY_AGAIN_LATER = 1013
+
+
+async def authenticate(session_id: Optional[str]) -> Optional[int]:
+    """The user id of a valid session, without holding a connection"""
+    async with session_factory() as db:
+        user = await get_session_user(session_id, db)
+        return user.id if user is not None else None
+
+
+async def ready_message(user_id: int) -> dict:
+    """The first message of a stream, with the cursor to sync from
+
+    Read only once subscribed, so every later commit is either covered by
+    the cursor or pushed as an event.
+    """
+    async with session_factory() as db:
+        return {"type": "ready", "cursor": await current_version(db, user_id)}
+
+
+async def session_active(session_id: Optional[str]) -> bool:
+    async with session_factory() as db:
+        return await get_session_user(session_id, db) is not None
+
+
+@router.websocket("")
+async def events_socket(websocket: WebSocket, session_id: Optional[str] = Cookie(None)):
+    """Push a message after every commit that changes the user's data
+
+    The first message is ``{"type": "ready", "cursor": n}``. After that each
+    ``{"type": "changes", "changes": [...]}`` lists the entities written;
+    ``{"type": "resync"}`` means too much changed to list. Fetch the data
+    through /sync. A client that falls behind is closed with 1013 and should
+    reconnect and sync from its last cursor.
+    """
+    # The cookie is sent with cross-site WebSocket handshakes too, so browsers
+    # must connect from an origin the API already trusts
+    if not origin_allowed(websocket.headers.get("origin")):
+        await websocket.close(code=POLICY_VIOLATION)
+        return
+    user_id = await authenticate(session_id)
+    if user_id is None:
+        await websocket.close(code=POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    broker = get_broker()
+    subscription = broker.subscribe(user_id)
+
+    async def push():
+        try:
+            await websocket.send_json(await ready_message(user_id))
+            while True:
+                message = await next_message(subscription, session_id)
+                if message is None:
+                    await websocket.close(code=POLICY_VIOLATION)
+                    break
+                await websocket.send_json(message)
+        except SlowConsumer:
+            await websocket.close(code=TRY_AGAIN_LATER)
+        except WebSocketDisconnect:
+            pass
+        group.cancel_scope.cancel()
+
+    async def watch():
+        # Notices the client going away while idle instead of at the next ping
+        await wait_closed(websocket)
+        group.cancel_scope.cancel()
+
+    try:
+        async with anyio.create_task_group() as group:
+            group.start_soon(push)
+            group.start_soon(watch)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+async def wait_closed(websocket: WebSocket) -> None:
+    """Return once the client disconnects, ignoring anything it sends"""
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+
+async def next_message(
+    subscription: Subscription, session_id: Optional[str]
+) -> Optional[dict]:
+    """The next message, or a ping after EVENTS_HEARTBEAT idle seconds
+
+    Returns None once the session has expired or been logged out.
+    """
+    message = await subscription.next(EVENTS_HEARTBEAT)
+    if message is not None:
+        return message
+    if not await session_active(session_id):
+        return None
+    return {"type": "ping"}
+
+
+def sse_event(message: dict) -> str:
+    return f"event: {message['type']}\ndata: {json.dumps(message)}\n\n"
+
+
+@router.get("")
+async def events_stream(session_id: Optional[str] = Cookie(None)):
+    """Server-sent events fallback for clients without WebSockets
+
+    Carries the same messages as the WebSocket, named by their type. The
+    stream ends when the client falls behind or the session ends, and
+    EventSource reconnects on its own.
+    """
+    user_id = await authenticate(session_id)
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    broker = get_broker()
+
+    async def stream():
+        # Subscribed here so a response that is never sent leaks nothing
+        subscription = broker.subscribe(user_id)
+        try:
+            yield sse_event(await ready_message(user_id))
+            while True:
+                message = await next_message(subscription, session_id)
+                if message is None:
+                    return
+                if message["type"] == "ping":
+                    # Comments keep proxies from timing the stream out
+                    yield ": ping\n\n"
+                else:
+                    yield sse_event(message)
+        except SlowConsumer:
+            return
+        finally:
+            broker.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
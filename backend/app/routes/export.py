@@ -0,0 +1,27 @@
+from datetime import date
+
+from app.auth import require_auth
+from app.export import ndjson_export, zip_export
+from app.models import User
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+
+router = APIRouter(prefix="/export", tags=["export"])
+
+
+@router.get("")
+async def export_account(
+    format: str = Query("ndjson", pattern="^(ndjson|zip)$"),
+    current_user: User = Depends(require_auth),
+):
+    """Download everything the user owns, see app.export for the layout"""
+    filename = f"notes-export-{date.today().isoformat()}.{format}"
+    if format == "zip":
+        body, media_type = zip_export(current_user.id), "application/zip"  # pyright: ignore[reportArgumentType]
+    else:
+        body, media_type = ndjson_export(current_user.id), "application/x-ndjson"  # pyright: ignore[reportArgumentType]
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
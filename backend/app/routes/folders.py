@@ -1,114 +1,306 @@
-from typing import List
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Literal, Optional, Sequence, Tuple
 
 from app.auth import require_auth
+from app.changes import FOLDER, NOTE, current_version, record_change, record_changes
+from app.content import decode_content
 from app.database import get_session
+from app.etag import etag_matches, not_modified, version_etag
+from app.responses import orjson_response
+from app.subtrees import subtree_ids
 from app.models import (
     Folder,
     FolderCreate,
+    FolderStats,
     FolderTreeNode,
     FolderTreeResponse,
     FolderUpdate,
     Note,
+    NoteContent,
     NoteRead,
+    NoteTag,
+    Tag,
+    TagRead,
     User,
 )
-from fastapi import APIRouter, Depends, HTTPException  # type: ignore
-from sqlalchemy.orm import selectinload
-from sqlmodel import Session, select  # type: ignore
+from fastapi import APIRouter, Depends, Header, HTTPException  # type: ignore
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import delete, func, update
+from sqlmodel import col, select  # type: ignore
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 router = APIRouter(prefix="/folders", tags=["folders"])
 
 
-def build_folder_tree_node(folder: Folder) -> FolderTreeNode:
-    """Recursively build a folder tree node with notes and children"""
-    return FolderTreeNode(
-        id=folder.id,  # pyright: ignore[reportArgumentType]
-        name=folder.name,
-        notes=[NoteRead.model_validate(note) for note in folder.notes],
-        children=[build_folder_tree_node(child) for child in folder.children],
-    )
+def build_folder_tree(
+    folders: Sequence[Folder], notes: Sequence[NoteRead]
+) -> Tuple[List[FolderTreeNode], List[NoteRead]]:
+    """Assemble flat folder and note rows into a tree in a single pass"""
+    nodes: Dict[int, FolderTreeNode] = {
+        folder.id: FolderTreeNode(id=folder.id, name=folder.name, notes=[], children=[])  # pyright: ignore[reportArgumentType]
+        for folder in folders
+    }
+
+    roots: List[FolderTreeNode] = []
+    for folder in folders:
+        parent = nodes.get(folder.parent_id) if folder.parent_id is not None else None
+        if parent is not None:
+            parent.children.append(nodes[folder.id])  # pyright: ignore[reportArgumentType]
+        else:
+            roots.append(nodes[folder.id])  # pyright: ignore[reportArgumentType]
+
+    orphaned_notes: List[NoteRead] = []
+    for note in notes:
+        folder_node = nodes.get(note.folder_id) if note.folder_id is not None else None
+        if folder_node is not None:
+            folder_node.notes.append(note)
+        else:
+            orphaned_notes.append(note)
+
+    return roots, orphaned_notes
 
 
-@router.get("/tree", response_model=FolderTreeResponse)
-def get_folder_tree(
-    current_user: User = Depends(require_auth), session: Session = Depends(get_session)
+@router.get(
+    "/tree",
+    response_model=FolderTreeResponse,
+    response_model_exclude_unset=True,
+    response_class=ORJSONResponse,
+)
+async def get_folder_tree(
+    fields: Optional[Literal["meta"]] = None,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
 ):
-    """Get complete folder tree with notes"""
+    """Get complete folder tree with notes
+
+    ``?fields=meta`` omits note content so the sidebar can render without
+    downloading every note body. ``cursor`` (also sent as ``X-Sync-Cursor``)
+    is where a client that bootstraps from the tree starts calling /sync.
+    """
+    version = await current_version(session, current_user.id)  # pyright: ignore[reportArgumentType]
+    etag = version_etag("folders", current_user.id, version, fields)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    include_content = fields != "meta"
 
-    top_level_folders = session.exec(
-        select(Folder)
-        .options(selectinload(Folder.notes).selectinload(Note.tags))
-        .where(Folder.parent_id == None)
-        .where(Folder.user_id == current_user.id)
+    folders = (
+        await session.exec(
+            select(Folder).where(Folder.user_id == current_user.id).order_by(Folder.id)  # pyright: ignore[reportArgumentType]
+        )
     ).all()
 
-    orphaned_notes = session.exec(
-        select(Note)
-        .options(selectinload(Note.tags))
-        .where(Note.folder_id == None)
-        .where(Note.user_id == current_user.id)
+    if include_content:
+        result = await session.exec(
+            select(Note, NoteContent.encoding, NoteContent.data)
+            .outerjoin(NoteContent, NoteContent.note_id == Note.id)  # pyright: ignore[reportArgumentType]
+            .where(Note.user_id == current_user.id)
+            .order_by(Note.id)  # pyright: ignore[reportArgumentType]
+        )
+        note_rows = [
+            (note, decode_content(encoding, data)) for note, encoding, data in result.all()
+        ]
+    else:
+        result = await session.exec(
+            select(Note).where(Note.user_id == current_user.id).order_by(Note.id)  # pyright: ignore[reportArgumentType]
+        )
+        note_rows = [(note, None) for note in result.all()]
+
+    tag_rows = (
+        await session.exec(
+            select(NoteTag.note_id, Tag)
+            .join(Tag, Tag.id == NoteTag.tag_id)  # pyright: ignore[reportArgumentType]
+            .join(Note, Note.id == NoteTag.note_id)  # pyright: ignore[reportArgumentType]
+            .where(Note.user_id == current_user.id)
+        )
     ).all()
 
-    tree = [build_folder_tree_node(folder) for folder in top_level_folders]
+    tags_by_note: Dict[int, List[TagRead]] = defaultdict(list)
+    for note_id, tag in tag_rows:
+        tags_by_note[note_id].append(TagRead.model_validate(tag))
+
+    notes = []
+    for note, content in note_rows:
+        note_data = {
+            "id": note.id,
+            "title": note.title,
+            "folder_id": note.folder_id,
+            "created_at": note.created_at,
+            "updated_at": note.updated_at,
+            "tags": tags_by_note.get(note.id, []),  # pyright: ignore[reportArgumentType]
+        }
+        if include_content:
+            note_data["content"] = content
+        notes.append(NoteRead(**note_data))
 
-    return FolderTreeResponse(
-        folders=tree,
-        orphaned_notes=[NoteRead.model_validate(note) for note in orphaned_notes],
+    tree, orphaned_notes = build_folder_tree(folders, notes)
+
+    return orjson_response(
+        # Read before the data, so syncing from it may repeat but never miss a change
+        FolderTreeResponse(folders=tree, orphaned_notes=orphaned_notes, cursor=version),
+        headers={"ETag": etag, "X-Sync-Cursor": str(version)},
+        exclude_unset=True,
     )
 
 
 @router.get("/", response_model=List[Folder])
-def list_folders(session: Session = Depends(get_session)):
+async def list_folders(session: AsyncSession = Depends(get_session)):
     """Get flat list of all folders"""
-    folders = session.exec(select(Folder)).all()
-    return folders
+    folders = await session.exec(select(Folder))
+    return folders.all()
 
 
 @router.post("/", response_model=Folder)
-def create_folder(
+async def create_folder(
     folder: FolderCreate,
     current_user: User = Depends(require_auth),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
 ):
     """Create a new folder"""
     folder_data = folder.model_dump()
     folder_data["user_id"] = current_user.id
     db_folder = Folder.model_validate(folder_data)
     session.add(db_folder)
-    session.commit()
-    session.refresh(db_folder)
+    await session.flush()
+    await record_change(session, db_folder.user_id, FOLDER, db_folder.id)  # pyright: ignore[reportArgumentType]
+    await session.commit()
+    await session.refresh(db_folder)
     return db_folder
 
 
+@router.get("/{folder_id}/stats", response_model=FolderStats)
+async def get_folder_stats(
+    folder_id: int,
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    """Count a folder's notes and descendants at any depth in one statement"""
+    subtree = subtree_ids(Folder, folder_id, current_user.id)  # pyright: ignore[reportArgumentType]
+    note_count = select(func.count()).select_from(Note)
+    result = await session.exec(
+        select(
+            select(func.count()).select_from(subtree.subquery()).scalar_subquery(),
+            note_count.where(Note.folder_id == folder_id).scalar_subquery(),
+            note_count.where(col(Note.folder_id).in_(subtree)).scalar_subquery(),
+        )
+    )
+    size, notes, subtree_notes = result.one()
+    if not size:
+        raise HTTPException(status_code=404, detail="Folder not found")
+
+    return FolderStats(
+        folder_id=folder_id,
+        notes=notes,
+        subtree_notes=subtree_notes,
+        descendants=size - 1,
+    )
+
+
 @router.delete("/{folder_id}")
-def delete_folder(folder_id: int, session: Session = Depends(get_session)):
-    """Delete a folder"""
-    folder = session.get(Folder, folder_id)
-    if not folder:
+async def delete_folder(
+    folder_id: int,
+    mode: Literal["move_to_root", "cascade"] = "move_to_root",
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    """Delete a folder
+
+    ``mode=move_to_root`` lifts the folder's notes and subfolders to the top
+    level. ``mode=cascade`` deletes every descendant folder and all of their
+    notes.
+    """
+    folder = await session.get(Folder, folder_id)
+    if not folder or folder.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Folder not found")
 
-    session.delete(folder)
-    session.commit()
+    if mode == "cascade":
+        subtree = subtree_ids(Folder, folder_id, current_user.id)  # pyright: ignore[reportArgumentType]
+        subtree_notes = select(Note.id).where(col(Note.folder_id).in_(subtree))
+        folder_ids = (await session.exec(subtree)).all()
+        note_ids = (await session.exec(subtree_notes)).all()
+
+        await session.execute(
+            delete(NoteTag).where(col(NoteTag.note_id).in_(subtree_notes)),
+            execution_options={"synchronize_session": False},
+        )
+        await session.execute(
+            delete(Note).where(col(Note.id).in_(subtree_notes)),
+            execution_options={"synchronize_session": False},
+        )
+        await session.execute(
+            delete(Folder).where(col(Folder.id).in_(subtree)),
+            execution_options={"synchronize_session": False},
+        )
+        await record_changes(session, current_user.id, NOTE, note_ids, deleted=True)  # pyright: ignore[reportArgumentType]
+        await record_changes(session, current_user.id, FOLDER, folder_ids, deleted=True)  # pyright: ignore[reportArgumentType]
+        await session.commit()
+        return {"message": "Folder deleted", "folders": len(folder_ids), "notes": len(note_ids)}
+
+    child_ids = (await session.exec(select(Folder.id).where(Folder.parent_id == folder_id))).all()
+    note_ids = (await session.exec(select(Note.id).where(Note.folder_id == folder_id))).all()
+    await session.execute(
+        update(Folder).where(col(Folder.parent_id) == folder_id).values(parent_id=None),
+        execution_options={"synchronize_session": False},
+    )
+    await session.execute(
+        update(Note)
+        .where(col(Note.folder_id) == folder_id)
+        # Note ETags come from updated_at, so the move has to change it
+        .values(folder_id=None, updated_at=datetime.utcnow()),
+        execution_options={"synchronize_session": False},
+    )
+    await session.execute(
+        delete(Folder).where(col(Folder.id) == folder_id),
+        execution_options={"synchronize_session": False},
+    )
+    await record_changes(session, current_user.id, NOTE, note_ids)  # pyright: ignore[reportArgumentType]
+    await record_changes(session, current_user.id, FOLDER, child_ids)  # pyright: ignore[reportArgumentType]
+    await record_change(session, current_user.id, FOLDER, folder_id, deleted=True)  # pyright: ignore[reportArgumentType]
+    await session.commit()
     return {"message": "Folder deleted"}
 
 
 @router.patch("/{folder_id}")
-def update_folder(
-    folder_id: int, folder_update: FolderUpdate, session: Session = Depends(get_session)
+async def update_folder(
+    folder_id: int,
+    folder_update: FolderUpdate,
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
 ):
-    """Update a folder"""
-    folder = session.get(Folder, folder_id)
-    if not folder:
+    """Update a folder
+
+    Moving a folder under itself or one of its descendants is rejected.
+    """
+    folder = await session.get(Folder, folder_id)
+    if not folder or folder.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Folder not found")
 
     update_data = folder_update.model_dump(exclude_unset=True)
 
+    parent_id = update_data.get("parent_id")
+    if parent_id is not None:
+        parent = await session.get(Folder, parent_id)
+        if not parent or parent.user_id != current_user.id:
+            raise HTTPException(status_code=404, detail="Parent folder not found")
+        cycle = await session.exec(
+            select(Folder.id)
+            .where(Folder.id == parent_id)
+            .where(col(Folder.id).in_(subtree_ids(Folder, folder_id, current_user.id)))  # pyright: ignore[reportArgumentType]
+        )
+        if cycle.first() is not None:
+            raise HTTPException(
+                status_code=400, detail="Cannot move a folder into its own subtree"
+            )
+
     for key, value in update_data.items():
         setattr(folder, key, value)
 
     session.add(folder)
-    session.commit()
+    await record_change(session, folder.user_id, FOLDER, folder_id)
+    await session.commit()
 
-    session.refresh(folder)
+    await session.refresh(folder)
 
     return folder
@@ -1,69 +1,581 @@
+import base64
+import binascii
 from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple, Type, Union
 
 from app.auth import require_auth
-from app.database import get_session
-from app.models import Note, NoteCreate, NoteRead, NoteUpdate, User
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session, select
+from app.autosave import PendingWrite, autosave_buffer
+from app.changes import NOTE, current_version, record_change, record_changes
+from app.content import (
+    apply_edits,
+    content_version,
+    decode_content,
+    load_content,
+    load_stored_content,
+    replace_content,
+    save_contents,
+)
+from app.database import get_session, session_factory
+from app.etag import etag_matches, not_modified, version_etag
+from app.responses import orjson_response
+from app.revisions import HEAD, list_revisions, load_revision
+from app.search import MAX_SEARCH_TOKENS, index_notes, normalize_tokens, search_query
+from app.tagging import replace_note_tags, require_owned_links
+from app.models import (
+    BulkNoteRequest,
+    BulkNoteResponse,
+    Folder,
+    Note,
+    NoteClientId,
+    NoteContent,
+    NoteCreate,
+    NoteDetail,
+    NotePage,
+    NoteRead,
+    NoteSummary,
+    NoteTag,
+    NoteTagsUpdate,
+    NoteUpdate,
+    NoteVersion,
+    RevisionDetail,
+    RevisionRead,
+    Tag,
+    TagRead,
+    User,
+)
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import delete, insert, tuple_, update
+from sqlalchemy.orm import selectinload
+from sqlmodel import SQLModel, col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 router = APIRouter(prefix="/notes", tags=["notes"])
 
+MAX_PAGE_SIZE = 200
+STREAM_BATCH_SIZE = 500
+MAX_BULK_NOTES = 10000
 
-@router.get("/", response_model=list[NoteRead])
-def list_notes(session: Session = Depends(get_session)):
-    notes = session.exec(select(Note).order_by(Note.updated_at.desc())).all()  # pyright: ignore[reportAttributeAccessIssue]
-    return notes
 
+def encode_cursor(note: Note) -> str:
+    raw = f"{note.updated_at.isoformat()}|{note.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
 
 
-@router.post("/", response_model=Note)
-def create_note(
-    note: NoteCreate,
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        updated_at, note_id = (
+            base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        )
+        return datetime.fromisoformat(updated_at), int(note_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def user_notes_query(user_id: int):
+    """Notes for a user, newest first, matching ix_note_user_updated"""
+    return (
+        select(Note)
+        .options(selectinload(Note.tags))  # pyright: ignore[reportArgumentType]
+        .where(Note.user_id == user_id)
+        .order_by(Note.updated_at.desc(), Note.id.desc())  # pyright: ignore[reportAttributeAccessIssue]
+    )
+
+
+@router.get("/", response_model=NotePage, response_class=ORJSONResponse)
+async def list_notes(
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    if_none_match: Optional[str] = Header(None),
     current_user: User = Depends(require_auth),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
 ):
+    version = await current_version(session, current_user.id)  # pyright: ignore[reportArgumentType]
+    etag = version_etag("notes", current_user.id, version, cursor, limit)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    query = user_notes_query(current_user.id)  # pyright: ignore[reportArgumentType]
+    if cursor:
+        updated_at, note_id = decode_cursor(cursor)
+        query = query.where(tuple_(Note.updated_at, Note.id) < (updated_at, note_id))
+
+    notes = (await session.exec(query.limit(limit + 1))).all()
+
+    next_cursor = None
+    if len(notes) > limit:
+        notes = notes[:limit]
+        next_cursor = encode_cursor(notes[-1])
+
+    return orjson_response(
+        NotePage(
+            notes=[NoteSummary.model_validate(note) for note in notes],
+            next_cursor=next_cursor,
+        ),
+        headers={"ETag": etag},
+    )
+
+
+@router.get("/stream")
+async def stream_notes(current_user: User = Depends(require_auth)):
+    """Stream every note as NDJSON without materializing the full result"""
+    query = (
+        user_notes_query(current_user.id)  # pyright: ignore[reportArgumentType]
+        .add_columns(NoteContent.encoding, NoteContent.data)
+        .outerjoin(NoteContent, NoteContent.note_id == Note.id)  # pyright: ignore[reportArgumentType]
+        .execution_options(yield_per=STREAM_BATCH_SIZE)
+    )
+
+    async def generate():
+        # The stream outlives the request-scoped session, so use a dedicated one
+        async with session_factory() as session:
+            rows = await session.stream(query)
+            async for note, encoding, data in rows:
+                note_read = NoteRead.model_validate(note)
+                note_read.content = decode_content(encoding, data)
+                yield note_read.model_dump_json() + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+def note_detail(
+    note: Note, content: str, pending: Optional[PendingWrite] = None
+) -> NoteDetail:
+    """Build the response for a note, overlaid with its unwritten autosaves"""
     note_data = note.model_dump()
+    if pending is not None:
+        note_data.update(pending.fields, updated_at=pending.updated_at)
+        if pending.content is not None:
+            content = pending.content
+    return NoteDetail(**note_data, content=content, version=content_version(content))
+
+
+def note_response(detail: NoteDetail, prefer: Optional[str], response: Response):
+    """Honour ``Prefer: return=minimal`` by sending only the new version"""
+    if prefer is None or "return=minimal" not in prefer.replace(" ", "").split(","):
+        return detail
+    response.headers["Preference-Applied"] = "return=minimal"
+    return NoteVersion(id=detail.id, version=detail.version, updated_at=detail.updated_at)
+
+
+@router.post("/", response_model=NoteDetail)
+async def create_note(
+    note: NoteCreate,
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    note_data = note.model_dump(exclude={"content", "search_tokens"})
     note_data["user_id"] = current_user.id
     db_note = Note.model_validate(note_data)
     session.add(db_note)
-    session.commit()
-    session.refresh(db_note)
-    return db_note
+    await session.flush()
+    await save_contents(session, {db_note.id: note.content})  # pyright: ignore[reportArgumentType]
+    if note.search_tokens is not None:
+        await index_notes(session, db_note.user_id, {db_note.id: note.search_tokens})  # pyright: ignore[reportArgumentType]
+    await record_change(session, db_note.user_id, NOTE, db_note.id)  # pyright: ignore[reportArgumentType]
+    await session.commit()
+    return note_detail(db_note, note.content)
 
 
-@router.get("/{note_id}", response_model=Note)
-def get_note(note_id: int, session: Session = Depends(get_session)):
-    note = session.get(Note, note_id)
-    if not note:
+async def require_owned(
+    session: AsyncSession, model: Type[SQLModel], ids: Set[int], user_id: int
+) -> None:
+    """Reject the request unless every id in ``ids`` belongs to the user"""
+    if not ids:
+        return
+    found = await session.exec(
+        select(model.id)  # pyright: ignore[reportAttributeAccessIssue]
+        .where(col(model.id).in_(ids))  # pyright: ignore[reportAttributeAccessIssue]
+        .where(model.user_id == user_id)  # pyright: ignore[reportAttributeAccessIssue]
+    )
+    if len(found.all()) != len(ids):
+        raise HTTPException(
+            status_code=404, detail=f"{model.__name__} not found"
+        )
+
+
+@router.post("/bulk", response_model=BulkNoteResponse)
+async def bulk_create_notes(
+    data: BulkNoteRequest,
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    """Create many notes in one transaction, returning their ids in order
+
+    With ``upsert`` set, notes whose ``client_id`` was imported before are
+    updated in place and have their tags replaced, so an import can be re-run.
+    """
+    if len(data.notes) > MAX_BULK_NOTES:
+        raise HTTPException(
+            status_code=413, detail=f"At most {MAX_BULK_NOTES} notes per request"
+        )
+
+    client_ids = [note.client_id for note in data.notes if note.client_id]
+    if len(client_ids) != len(set(client_ids)):
+        raise HTTPException(status_code=400, detail="Duplicate client_id")
+
+    user_id: int = current_user.id  # pyright: ignore[reportAssignmentType]
+    await require_owned(
+        session,
+        Folder,
+        {note.folder_id for note in data.notes if note.folder_id is not None},
+        user_id,
+    )
+    await require_owned(
+        session, Tag, {tag_id for note in data.notes for tag_id in note.tag_ids}, user_id
+    )
+
+    existing: Dict[str, int] = {}
+    if client_ids:
+        result = await session.exec(
+            select(NoteClientId.client_id, NoteClientId.note_id)
+            .where(NoteClientId.user_id == user_id)
+            .where(col(NoteClientId.client_id).in_(client_ids))
+        )
+        existing = dict(result.all())
+    if existing and not data.upsert:
+        raise HTTPException(status_code=409, detail="Note already imported")
+
+    ids: List[int] = [0] * len(data.notes)
+    created = [
+        (i, note) for i, note in enumerate(data.notes)
+        if note.client_id not in existing
+    ]
+    updated = [
+        (i, note) for i, note in enumerate(data.notes)
+        if note.client_id in existing
+    ]
+
+    # One timestamp for the whole batch, in UTC like every other note write
+    now = datetime.utcnow()
+    if created:
+        result = await session.execute(
+            insert(Note).returning(Note.id, sort_by_parameter_order=True),  # pyright: ignore[reportArgumentType]
+            [
+                {
+                    "title": note.title,
+                    "folder_id": note.folder_id,
+                    "user_id": user_id,
+                    "created_at": now,
+                    "updated_at": now,
+                }
+                for _, note in created
+            ],
+        )
+        for (i, _), note_id in zip(created, result.scalars()):
+            ids[i] = note_id
+
+        client_rows = [
+            {"user_id": user_id, "client_id": note.client_id, "note_id": ids[i]}
+            for i, note in created
+            if note.client_id
+        ]
+        if client_rows:
+            await session.execute(insert(NoteClientId), client_rows)
+
+    if updated:
+        for i, note in updated:
+            ids[i] = existing[note.client_id]  # pyright: ignore[reportArgumentType]
+        await session.execute(
+            update(Note),
+            [
+                {
+                    "id": ids[i],
+                    "title": note.title,
+                    "folder_id": note.folder_id,
+                    "updated_at": now,
+                }
+                for i, note in updated
+            ],
+        )
+        await session.execute(
+            delete(NoteTag).where(col(NoteTag.note_id).in_([ids[i] for i, _ in updated]))
+        )
+
+    await save_contents(
+        session, {ids[i]: note.content for i, note in enumerate(data.notes)}
+    )
+
+    links = [
+        {"note_id": ids[i], "tag_id": tag_id}
+        for i, note in enumerate(data.notes)
+        for tag_id in dict.fromkeys(note.tag_ids)
+    ]
+    if links:
+        await session.execute(insert(NoteTag), links)
+
+    await index_notes(
+        session,
+        user_id,
+        {
+            ids[i]: note.search_tokens
+            for i, note in enumerate(data.notes)
+            if note.search_tokens is not None
+        },
+    )
+    await record_changes(session, user_id, NOTE, ids)
+    await session.commit()
+
+    return BulkNoteResponse(ids=ids)
+
+
+@router.get("/search", response_model=list[NoteSummary], response_class=ORJSONResponse)
+async def search_notes(
+    tokens: list[str] = Query([]),
+    folder_id: Optional[int] = None,
+    tag_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    """Search notes by blind tokens, optionally within a folder or tag subtree
+
+    Results are metadata only; fetch a note by id for its content.
+    """
+    tokens = normalize_tokens(tokens)
+    if len(tokens) > MAX_SEARCH_TOKENS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {MAX_SEARCH_TOKENS} tokens per search"
+        )
+    if not tokens and folder_id is None and tag_id is None:
+        raise HTTPException(status_code=400, detail="Nothing to search for")
+
+    query = (
+        search_query(current_user.id, tokens, folder_id, tag_id)  # pyright: ignore[reportArgumentType]
+        .options(selectinload(Note.tags))  # pyright: ignore[reportArgumentType]
+        .limit(limit)
+    )
+    notes = await session.exec(query)
+    return orjson_response([NoteSummary.model_validate(note) for note in notes.all()])
+
+
+@router.get("/{note_id}", response_model=NoteDetail)
+async def get_note(
+    note_id: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    session: AsyncSession = Depends(get_session),
+):
+    # Check freshness from the index before pulling the content
+    result = await session.exec(select(Note.updated_at).where(Note.id == note_id))
+    updated_at = result.first()
+    if updated_at is None:
         raise HTTPException(status_code=404, detail="Note not found")
-    return note
+
+    # Autosaves still in the write-behind buffer are part of the note
+    pending = autosave_buffer.get(note_id)
+    if pending is not None:
+        updated_at = pending.updated_at
+
+    etag = version_etag("note", note_id, updated_at.isoformat())
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+
+    result = await session.exec(
+        select(Note, NoteContent.encoding, NoteContent.data)
+        .outerjoin(NoteContent, NoteContent.note_id == Note.id)  # pyright: ignore[reportArgumentType]
+        .where(Note.id == note_id)
+    )
+    note, encoding, data = result.one()
+    return note_detail(note, decode_content(encoding, data), pending)
 
 
-@router.patch("/{note_id}", response_model=Note)
-def update_note(
-    note_id: int, note_update: NoteUpdate, session: Session = Depends(get_session)
+async def apply_patch(
+    session: AsyncSession, note_id: int, note_update: NoteUpdate
+) -> str:
+    """Check the base version, then write the patched (or replacement) content"""
+    stored = await load_stored_content(session, note_id)
+    current = decode_content(*stored) if stored is not None else ""
+    current_hash = content_version(current)
+    conflict = HTTPException(
+        status_code=409,
+        detail={"message": "Note changed since base_version", "version": current_hash},
+    )
+    if current_hash != note_update.base_version:
+        raise conflict
+
+    if note_update.edits is not None:
+        try:
+            content = apply_edits(current, note_update.edits)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    elif note_update.content is not None:
+        content = note_update.content
+    else:
+        # Nothing to write, the base version was only a precondition
+        return current
+
+    if not await replace_content(session, note_id, stored, content):
+        raise conflict
+    return content
+
+
+@router.patch("/{note_id}", response_model=Union[NoteDetail, NoteVersion])
+async def update_note(
+    note_id: int,
+    note_update: NoteUpdate,
+    response: Response,
+    prefer: Optional[str] = Header(None),
+    session: AsyncSession = Depends(get_session),
 ):
-    note = session.get(Note, note_id)
+    """Update a note
+
+    Send ``edits`` with the ``base_version`` they were made against instead of
+    the whole ``content`` to upload only what changed. A 409 means the note
+    moved on; fetch it again and rebase. ``Prefer: return=minimal`` answers
+    with just the new version and ``updated_at``.
+    """
+    note = await session.get(Note, note_id)
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
+    if note_update.edits is not None and note_update.content is not None:
+        raise HTTPException(status_code=400, detail="Send either content or edits")
+    if note_update.edits is not None and note_update.base_version is None:
+        raise HTTPException(status_code=400, detail="edits require a base_version")
+
+    update_data = note_update.model_dump(
+        exclude_unset=True,
+        exclude={"content", "search_tokens", "base_version", "edits"},
+    )
+
+    # Plain autosaves can wait in the write-behind buffer. Patches and search
+    # token changes need the stored state, so they are written through.
+    if (
+        autosave_buffer.enabled
+        and note_update.base_version is None
+        and note_update.search_tokens is None
+    ):
+        pending = autosave_buffer.put(
+            note_id, note.user_id, update_data, note_update.content
+        )
+        content = pending.content
+        if content is None:
+            content = await load_content(session, note_id)
+        return note_response(note_detail(note, content, pending), prefer, response)
+    if autosave_buffer.get(note_id) is not None:
+        # Base versions refer to what the client last saw, buffered or not
+        await autosave_buffer.flush()
 
-    update_data = note_update.model_dump(exclude_unset=True)
     for key, value in update_data.items():
         setattr(note, key, value)
 
+    content = note_update.content
+    if note_update.base_version is not None:
+        content = await apply_patch(session, note_id, note_update)
+    elif content is not None:
+        await save_contents(session, {note_id: content})
+
+    if note_update.search_tokens is not None:
+        await index_notes(session, note.user_id, {note_id: note_update.search_tokens})
+
     note.updated_at = datetime.utcnow()
     session.add(note)
-    session.commit()
-    session.refresh(note)
-    return note
+    await record_change(session, note.user_id, NOTE, note_id)
+    await session.commit()
+
+    if content is None:
+        content = await load_content(session, note_id)
+    return note_response(note_detail(note, content), prefer, response)
+
+
+@router.put("/{note_id}/tags", response_model=List[TagRead])
+async def replace_tags(
+    note_id: int,
+    data: NoteTagsUpdate,
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    """Replace the note's tags with exactly ``tag_ids``"""
+    tag_ids = set(data.tag_ids)
+    await require_owned_links(session, {note_id}, tag_ids, current_user.id)  # pyright: ignore[reportArgumentType]
+    await replace_note_tags(session, current_user.id, note_id, tag_ids)  # pyright: ignore[reportArgumentType]
+    await session.commit()
+
+    tags = await session.exec(
+        select(Tag)
+        .join(NoteTag, NoteTag.tag_id == Tag.id)  # pyright: ignore[reportArgumentType]
+        .where(NoteTag.note_id == note_id)
+        .order_by(Tag.id)  # pyright: ignore[reportArgumentType]
+    )
+    return tags.all()
+
+
+@router.get("/{note_id}/revisions", response_model=List[RevisionRead])
+async def get_revisions(
+    note_id: int,
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    """The note's saved versions, newest (the current body) first"""
+    await require_owned(session, Note, {note_id}, current_user.id)  # pyright: ignore[reportArgumentType]
+    if autosave_buffer.get(note_id) is not None:
+        await autosave_buffer.flush()
+    return await list_revisions(session, note_id)
+
+
+@router.get("/{note_id}/revisions/{number}", response_model=RevisionDetail)
+async def get_revision(
+    note_id: int,
+    number: int,
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    await require_owned(session, Note, {note_id}, current_user.id)  # pyright: ignore[reportArgumentType]
+    if autosave_buffer.get(note_id) is not None:
+        await autosave_buffer.flush()
+    loaded = await load_revision(session, note_id, number)
+    if loaded is None:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    revision, content = loaded
+    return RevisionDetail(
+        number=revision.number,
+        created_at=revision.created_at,
+        updated_at=revision.updated_at,
+        size=revision.size,
+        current=revision.kind == HEAD,
+        content=content,
+        version=content_version(content),
+    )
+
+
+@router.post("/{note_id}/revisions/{number}/restore", response_model=NoteDetail)
+async def restore_revision(
+    note_id: int,
+    number: int,
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    """Make an old revision's body current again
+
+    The restore is saved like any edit, so it becomes the newest revision
+    and the versions in between stay in the history.
+    """
+    await require_owned(session, Note, {note_id}, current_user.id)  # pyright: ignore[reportArgumentType]
+    if autosave_buffer.get(note_id) is not None:
+        await autosave_buffer.flush()
+    loaded = await load_revision(session, note_id, number)
+    if loaded is None:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    _, content = loaded
+
+    note = await session.get(Note, note_id)
+    await save_contents(session, {note_id: content})
+    note.updated_at = datetime.utcnow()  # pyright: ignore[reportOptionalMemberAccess]
+    session.add(note)
+    await record_change(session, current_user.id, NOTE, note_id)  # pyright: ignore[reportArgumentType]
+    await session.commit()
+    return note_detail(note, content)  # pyright: ignore[reportArgumentType]
 
 
 @router.delete("/{note_id}")
-def delete_note(note_id: int, session: Session = Depends(get_session)):
-    note = session.get(Note, note_id)
+async def delete_note(note_id: int, session: AsyncSession = Depends(get_session)):
+    note = await session.get(Note, note_id)
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
 
-    session.delete(note)
-    session.commit()
+    autosave_buffer.discard(note_id)
+    await session.delete(note)
+    await record_change(session, note.user_id, NOTE, note_id, deleted=True)
+    await session.commit()
     return {"message": "Note deleted"}
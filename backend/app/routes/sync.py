@@ -0,0 +1,124 @@
+from typing import Dict, Optional, Tuple
+
+from app.auth import require_auth
+from app.changes import FOLDER, NOTE, NOTE_TAG, TAG
+from app.content import load_contents
+from app.database import get_session
+from app.responses import orjson_response
+from app.models import (
+    ChangeLog,
+    Folder,
+    FolderRead,
+    Note,
+    NoteRead,
+    NoteTag,
+    SyncResponse,
+    Tag,
+    TagRead,
+    Tombstone,
+    User,
+)
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import tuple_
+from sqlalchemy.orm import selectinload
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+router = APIRouter(prefix="/sync", tags=["sync"])
+
+SYNC_BATCH_SIZE = 1000
+
+
+@router.get("", response_model=SyncResponse, response_class=ORJSONResponse)
+async def sync(
+    since: int = Query(0, ge=0),
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    """Return everything that changed after ``since``
+
+    Pass the returned ``cursor`` as ``since`` on the next call, repeating while
+    ``has_more`` is set. ``since=0`` returns everything the user has, since
+    data from before the change log was backfilled into it by a migration.
+    Clients that start from /folders/tree pass that response's ``cursor``.
+    """
+    result = await session.exec(
+        select(ChangeLog)
+        .where(ChangeLog.user_id == current_user.id)
+        .where(ChangeLog.version > since)
+        .order_by(ChangeLog.version)  # pyright: ignore[reportArgumentType]
+        .limit(SYNC_BATCH_SIZE + 1)
+    )
+    changes = result.all()
+
+    has_more = len(changes) > SYNC_BATCH_SIZE
+    changes = changes[:SYNC_BATCH_SIZE]
+
+    # Only the latest change per entity matters
+    latest: Dict[Tuple[str, int, Optional[int]], bool] = {}
+    for change in changes:
+        latest[(change.entity, change.entity_id, change.tag_id)] = change.deleted
+
+    deleted = [
+        Tombstone(entity=entity, id=entity_id, tag_id=tag_id)
+        for (entity, entity_id, tag_id), is_deleted in latest.items()
+        if is_deleted
+    ]
+
+    def changed(entity: str):
+        return [
+            key[1] for key, is_deleted in latest.items()
+            if key[0] == entity and not is_deleted
+        ]
+
+    note_ids, folder_ids, tag_ids = changed(NOTE), changed(FOLDER), changed(TAG)
+    link_keys = [
+        (key[1], key[2]) for key, is_deleted in latest.items()
+        if key[0] == NOTE_TAG and not is_deleted
+    ]
+
+    notes, folders, tags, note_tags = [], [], [], []
+    contents: Dict[int, str] = {}
+    if note_ids:
+        result = await session.exec(
+            select(Note)
+            .options(selectinload(Note.tags))  # pyright: ignore[reportArgumentType]
+            .where(col(Note.id).in_(note_ids))
+            .where(Note.user_id == current_user.id)
+        )
+        notes = result.all()
+        contents = await load_contents(session, note_ids)
+    if folder_ids:
+        result = await session.exec(
+            select(Folder)
+            .where(col(Folder.id).in_(folder_ids))
+            .where(Folder.user_id == current_user.id)
+        )
+        folders = result.all()
+    if tag_ids:
+        result = await session.exec(
+            select(Tag)
+            .where(col(Tag.id).in_(tag_ids))
+            .where(Tag.user_id == current_user.id)
+        )
+        tags = result.all()
+    if link_keys:
+        result = await session.exec(
+            select(NoteTag).where(tuple_(NoteTag.note_id, NoteTag.tag_id).in_(link_keys))
+        )
+        note_tags = result.all()
+
+    response = SyncResponse(
+        cursor=changes[-1].version if changes else since,
+        has_more=has_more,
+        notes=[
+            NoteRead.model_validate(note, update={"content": contents.get(note.id, "")})  # pyright: ignore[reportArgumentType]
+            for note in notes
+        ],
+        folders=[FolderRead.model_validate(folder) for folder in folders],
+        tags=[TagRead.model_validate(tag) for tag in tags],
+        note_tags=list(note_tags),
+        deleted=deleted,
+    )
+    return orjson_response(response)
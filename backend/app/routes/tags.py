@@ -1,91 +1,158 @@
+import os
+from typing import List, Optional, Sequence, Tuple
+
 from app.auth import require_auth
+from app.cache import TTLCache
+from app.changes import TAG, current_version, record_change, record_changes
 from app.database import get_session
+from app.etag import etag_matches, json_with_etag, not_modified, version_etag
+from app.tagging import add_links, require_owned_links
 from app.models import (
     NoteTag,
     Tag,
+    TagAssignRequest,
+    TagAssignResponse,
     TagCreate,
     TagTreeNode,
     TagTreeResponse,
     User,
 )
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
 from sqlalchemy.orm import selectinload
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 router = APIRouter(prefix="/tags", tags=["tags"])
 
+MAX_TAG_ASSIGNMENTS = 10000
+
+# user id -> (etag, serialized TagTreeResponse). Entries are checked against the
+# user's tag version, so writes made by other workers are picked up too
+tag_tree_cache: TTLCache[Tuple[str, bytes]] = TTLCache(
+    "tag_tree_cache",
+    maxsize=int(os.getenv("TAG_TREE_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("TAG_TREE_CACHE_TTL", "300")),
+)
+
 @router.get("/", response_model=list[Tag])
-def list_tags(session: Session = Depends(get_session)):
-    tags = session.exec(select(Tag)).all()
-    return tags
+async def list_tags(session: AsyncSession = Depends(get_session)):
+    tags = await session.exec(select(Tag))
+    return tags.all()
 
 @router.post('/', response_model=Tag)
-def create_tag(
+async def create_tag(
     tag: TagCreate,
     current_user: User = Depends(require_auth),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
     tag_data = tag.model_dump()
     tag_data["user_id"] = current_user.id
     db_tag = Tag.model_validate(tag_data)
 
     session.add(db_tag)
-    session.commit()
-    session.refresh(db_tag)
+    await session.flush()
+    await record_change(session, db_tag.user_id, TAG, db_tag.id)  # pyright: ignore[reportArgumentType]
+    await session.commit()
+    tag_tree_cache.invalidate(db_tag.user_id)
+    await session.refresh(db_tag)
     return db_tag
 
 
-def build_tag_tree_node(tag: Tag) -> TagTreeNode:
-    return TagTreeNode(
-        id= tag.id,
-        name = tag.name,
-        parent_id=tag.parent_id,
-        created_at=tag.created_at,
-        children = [build_tag_tree_node(child) for child in tag.children]
-    )
-
+def build_tag_tree(tags: Sequence[Tag]) -> List[TagTreeNode]:
+    """Assemble a user's flat tag rows into a tree in a single pass"""
+    nodes = {
+        tag.id: TagTreeNode(
+            id=tag.id,  # pyright: ignore[reportArgumentType]
+            name=tag.name,
+            parent_id=tag.parent_id,
+            created_at=tag.created_at,
+            children=[],
+        )
+        for tag in tags
+    }
+
+    roots: List[TagTreeNode] = []
+    for tag in tags:
+        parent = nodes.get(tag.parent_id) if tag.parent_id is not None else None
+        if parent is not None:
+            parent.children.append(nodes[tag.id])
+        else:
+            roots.append(nodes[tag.id])
+    return roots
 
 
 @router.get("/tree", response_model=TagTreeResponse)
-def get_tag_tree(session: Session = Depends(get_session)):
-    top_level_tags = session.exec(
-        select(Tag)
-        .options(selectinload(Tag.children))
-        .where(Tag.parent_id == None)
-    ).all()
+async def get_tag_tree(
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session),
+):
+    version = await current_version(session, current_user.id, TAG)  # pyright: ignore[reportArgumentType]
+    etag = version_etag("tags", current_user.id, version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
 
-    tree = [build_tag_tree_node(tag) for tag in top_level_tags]
-    return TagTreeResponse(tags=tree)
+    cached = tag_tree_cache.get(current_user.id)
+    if cached is not None and cached[0] == etag:
+        return json_with_etag(cached[1], etag)
+
+    tags = await session.exec(
+        select(Tag).where(Tag.user_id == current_user.id).order_by(Tag.id)  # pyright: ignore[reportArgumentType]
+    )
+    body = TagTreeResponse(tags=build_tag_tree(tags.all())).model_dump_json().encode()
+    tag_tree_cache.set(current_user.id, (etag, body))
+    return json_with_etag(body, etag)
 
 
 @router.post("/note/{note_id}/tag/{tag_id}", response_model=NoteTag)
-def add_tag_to_note(
+async def add_tag_to_note(
     note_id: int,
     tag_id: int,
     current_user: User = Depends(require_auth),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    existing = session.exec(
-        select(NoteTag)
-        .where(NoteTag.note_id == note_id)
-        .where(NoteTag.tag_id == tag_id)
-    ).first()
+    await require_owned_links(session, {note_id}, {tag_id}, current_user.id)  # pyright: ignore[reportArgumentType]
+    # Adding a link that already exists is a no-op
+    await add_links(session, current_user.id, [(note_id, tag_id)])  # pyright: ignore[reportArgumentType]
+    await session.commit()
+    return NoteTag(note_id=note_id, tag_id=tag_id)
 
-    if existing:
-        return {"message": "Tag already added"}
 
-    note_tag = NoteTag(note_id=note_id, tag_id=tag_id)
-    session.add(note_tag)
-    session.commit()
-
-    return note_tag
+@router.post("/assign", response_model=TagAssignResponse)
+async def assign_tags(
+    data: TagAssignRequest,
+    current_user: User = Depends(require_auth),
+    session: AsyncSession = Depends(get_session)
+):
+    """Add many (note, tag) links at once, skipping ones that already exist"""
+    if len(data.links) > MAX_TAG_ASSIGNMENTS:
+        raise HTTPException(
+            status_code=413, detail=f"At most {MAX_TAG_ASSIGNMENTS} links per request"
+        )
+
+    links = [(link.note_id, link.tag_id) for link in data.links]
+    await require_owned_links(
+        session,
+        {note_id for note_id, _ in links},
+        {tag_id for _, tag_id in links},
+        current_user.id,  # pyright: ignore[reportArgumentType]
+    )
+    added = await add_links(session, current_user.id, links)  # pyright: ignore[reportArgumentType]
+    await session.commit()
+    return TagAssignResponse(added=len(added))
 
 @router.delete("/{tag_id}")
-def delete_note(tag_id: int, session: Session = Depends(get_session)):
-    tag = session.get(Tag, tag_id)
+async def delete_note(tag_id: int, session: AsyncSession = Depends(get_session)):
+    tag = await session.get(Tag, tag_id, options=[selectinload(Tag.children)])
     if not tag:
         raise HTTPException(status_code=404, detail="Tag not found")
 
-    session.delete(tag)
-    session.commit()
+    # Deleting the tag detaches its child tags
+    children = [child.id for child in tag.children]
+    await record_changes(session, tag.user_id, TAG, children)  # pyright: ignore[reportArgumentType]
+
+    await session.delete(tag)
+    await record_change(session, tag.user_id, TAG, tag_id, deleted=True)
+    await session.commit()
+    tag_tree_cache.invalidate(tag.user_id)
     return {"message": "tag deleted"}
@@ -0,0 +1,78 @@
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import delete, func, insert
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.models import Folder, Note, NoteSearchToken, NoteTag, Tag
+from app.subtrees import subtree_ids
+
+MAX_SEARCH_TOKENS = 32
+MAX_TOKEN_LENGTH = 128
+
+
+def normalize_tokens(tokens: Iterable[str]) -> List[str]:
+    """Deduplicate tokens, keeping the first occurrence's position"""
+    return [
+        token for token in dict.fromkeys(tokens)
+        if token and len(token) <= MAX_TOKEN_LENGTH
+    ]
+
+
+async def index_notes(
+    session: AsyncSession, user_id: int, tokens_by_note: Dict[int, List[str]]
+) -> None:
+    """Replace the search tokens of each note in ``tokens_by_note``"""
+    if not tokens_by_note:
+        return
+    await session.execute(
+        delete(NoteSearchToken).where(col(NoteSearchToken.note_id).in_(tokens_by_note))
+    )
+    rows = [
+        {"note_id": note_id, "token": token, "user_id": user_id}
+        for note_id, tokens in tokens_by_note.items()
+        for token in normalize_tokens(tokens)
+    ]
+    if rows:
+        await session.execute(insert(NoteSearchToken), rows)
+
+
+def search_query(
+    user_id: int,
+    tokens: List[str],
+    folder_id: Optional[int] = None,
+    tag_id: Optional[int] = None,
+):
+    """Notes containing every token, ranked by matching tags then recency
+
+    Posting lists are intersected in SQL by counting how many of the requested
+    tokens each note has. ``folder_id`` and ``tag_id`` restrict the results to
+    that folder or tag and everything beneath it.
+    """
+    query = select(Note).where(Note.user_id == user_id)
+
+    if tokens:
+        matches = (
+            select(NoteSearchToken.note_id)
+            .where(NoteSearchToken.user_id == user_id)
+            .where(col(NoteSearchToken.token).in_(tokens))
+            .group_by(NoteSearchToken.note_id)  # pyright: ignore[reportArgumentType]
+            .having(func.count() == len(tokens))
+            .subquery()
+        )
+        query = query.join(matches, matches.c.note_id == Note.id)  # pyright: ignore[reportArgumentType]
+
+    if folder_id is not None:
+        query = query.where(col(Note.folder_id).in_(subtree_ids(Folder, folder_id, user_id)))
+
+    if tag_id is not None:
+        tag_matches = (
+            select(func.count())
+            .where(NoteTag.note_id == Note.id)
+            .where(col(NoteTag.tag_id).in_(subtree_ids(Tag, tag_id, user_id)))
+            .correlate(Note)
+            .scalar_subquery()
+        )
+        query = query.where(tag_matches > 0).order_by(tag_matches.desc())
+
+    return query.order_by(col(Note.updated_at).desc(), col(Note.id).desc())
@@ -0,0 +1,24 @@
+from typing import Type, Union
+
+from sqlalchemy import Select
+from sqlmodel import select
+
+from app.models import Folder, Tag
+
+
+def subtree_ids(model: Union[Type[Folder], Type[Tag]], root_id: int, user_id: int) -> Select:
+    """Select the ids of ``root_id`` and all of its descendants in one recursive CTE
+
+    UNION rather than UNION ALL drops rows already seen, so the recursion ends
+    even if the parent links form a cycle.
+    """
+    tree = (
+        select(model.id)
+        .where(model.id == root_id)
+        .where(model.user_id == user_id)
+        .cte(f"{model.__tablename__}_subtree", recursive=True)
+    )
+    tree = tree.union(
+        select(model.id).join(tree, model.parent_id == tree.c.id)  # pyright: ignore[reportArgumentType]
+    )
+    return select(tree.c.id)
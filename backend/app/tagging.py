@@ -0,0 +1,85 @@
+from typing import Iterable, List, Set, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import delete, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.changes import record_link_changes
+from app.database import IS_SQLITE
+from app.models import Note, NoteTag, Tag
+
+Link = Tuple[int, int]
+
+
+async def require_owned_links(
+    session: AsyncSession, note_ids: Set[int], tag_ids: Set[int], user_id: int
+) -> None:
+    """Reject the request unless every note and tag belongs to the user
+
+    Both sets are counted in a single round trip.
+    """
+    owned_notes = (
+        select(func.count())
+        .select_from(Note)
+        .where(col(Note.id).in_(note_ids))
+        .where(Note.user_id == user_id)
+    )
+    owned_tags = (
+        select(func.count())
+        .select_from(Tag)
+        .where(col(Tag.id).in_(tag_ids))
+        .where(Tag.user_id == user_id)
+    )
+    result = await session.exec(
+        select(owned_notes.scalar_subquery(), owned_tags.scalar_subquery())
+    )
+    notes, tags = result.one()
+    if notes != len(note_ids):
+        raise HTTPException(status_code=404, detail="Note not found")
+    if tags != len(tag_ids):
+        raise HTTPException(status_code=404, detail="Tag not found")
+
+
+async def add_links(
+    session: AsyncSession, user_id: int, links: Iterable[Link]
+) -> List[Link]:
+    """Insert links that do not exist yet and return the ones that were added
+
+    Uses INSERT ... ON CONFLICT DO NOTHING so concurrent requests adding the
+    same link cannot race each other into an integrity error.
+    """
+    rows = [
+        {"note_id": note_id, "tag_id": tag_id}
+        for note_id, tag_id in dict.fromkeys(links)
+    ]
+    if not rows:
+        return []
+    dialect = sqlite if IS_SQLITE else postgresql
+    result = await session.execute(
+        dialect.insert(NoteTag)
+        .on_conflict_do_nothing()
+        .returning(NoteTag.note_id, NoteTag.tag_id),  # pyright: ignore[reportArgumentType]
+        rows,
+    )
+    added = [(note_id, tag_id) for note_id, tag_id in result.all()]
+    await record_link_changes(session, user_id, added)
+    return added
+
+
+async def replace_note_tags(
+    session: AsyncSession, user_id: int, note_id: int, tag_ids: Set[int]
+) -> Tuple[List[Link], List[Link]]:
+    """Make ``tag_ids`` the note's exact tag set, returning (added, removed)"""
+    result = await session.execute(
+        delete(NoteTag)
+        .where(col(NoteTag.note_id) == note_id)
+        .where(col(NoteTag.tag_id).not_in(tag_ids))
+        .returning(NoteTag.note_id, NoteTag.tag_id),  # pyright: ignore[reportArgumentType]
+        execution_options={"synchronize_session": False},
+    )
+    removed = [(note_id, tag_id) for note_id, tag_id in result.all()]
+    await record_link_changes(session, user_id, removed, deleted=True)
+    added = await add_links(session, user_id, ((note_id, tag_id) for tag_id in tag_ids))
+    return added, removed
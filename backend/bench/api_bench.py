@@ -0,0 +1,298 @@
+"""Load-test the API in-process and compare the results against a baseline.
+
+    python -m bench.api_bench --users 20 --notes 500 --json results.json
+    python -m bench.api_bench --baseline results.json
+
+Seeds a throwaway SQLite database, then drives the main read and write
+endpoints through an ASGI client with no network in between. Each scenario
+reports throughput, latency percentiles and SQL statements per request. With
+``--baseline`` the run exits non-zero when a scenario got slower than the
+tolerance allows or started issuing more queries.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+PASSWORD = "bench-password"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--notes", type=int, default=500, help="notes per user")
+    parser.add_argument("--folders", type=int, default=50, help="folders per user")
+    parser.add_argument("--folder-depth", type=int, default=6)
+    parser.add_argument("--tags", type=int, default=30, help="tags per user")
+    parser.add_argument("--tags-per-note", type=int, default=3)
+    parser.add_argument("--content-bytes", type=int, default=1024)
+    parser.add_argument("--requests", type=int, default=200, help="per scenario")
+    parser.add_argument("--login-requests", type=int, default=20)
+    parser.add_argument(
+        "--warmup", type=int, default=10, help="unmeasured requests per scenario"
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare against a previous --json file")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25,
+        help="allowed p95 slowdown relative to the baseline",
+    )
+    return parser.parse_args()
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def seed(args, rng):
+    from sqlalchemy import insert
+
+    from app import passwords
+    from app.content import content_row
+    from app.database import engine, migrate_database
+    from app.models import Folder, Note, NoteContent, NoteTag, Session, Tag, User
+
+    await migrate_database()
+    now = datetime.now()
+    hashed = passwords.hash_password(PASSWORD, args.bcrypt_rounds)
+    users = []
+    folder_id = note_id = tag_id = 0
+
+    async with engine.begin() as conn:
+        for user_id in range(1, args.users + 1):
+            await conn.execute(
+                insert(User),
+                [{"id": user_id, "username": f"bench{user_id}",
+                  "email": f"bench{user_id}@example.com", "hashed_password": hashed,
+                  "salt": "x", "wrapped_master_key": "x", "created_at": now}],
+            )
+            session_id = f"bench-session-{user_id}"
+            await conn.execute(
+                insert(Session),
+                [{"session_id": session_id, "user_id": user_id, "created_at": now,
+                  "expires_at": now + timedelta(days=1)}],
+            )
+
+            # Attach each folder under a random earlier one that is not yet at
+            # the maximum depth
+            folders, depth = [], {}
+            for _ in range(args.folders):
+                folder_id += 1
+                parents = [f for f in folders if depth[f] < args.folder_depth]
+                parent = rng.choice(parents) if parents and rng.random() < 0.8 else None
+                depth[folder_id] = depth[parent] + 1 if parent else 1
+                folders.append(folder_id)
+                await conn.execute(
+                    insert(Folder),
+                    [{"id": folder_id, "name": f"f{folder_id}", "user_id": user_id,
+                      "parent_id": parent, "created_at": now}],
+                )
+
+            tags = []
+            for _ in range(args.tags):
+                tag_id += 1
+                parent = rng.choice(tags) if tags and rng.random() < 0.5 else None
+                tags.append(tag_id)
+                await conn.execute(
+                    insert(Tag),
+                    [{"id": tag_id, "name": f"t{tag_id}", "user_id": user_id,
+                      "parent_id": parent, "created_at": now}],
+                )
+
+            notes = list(range(note_id + 1, note_id + args.notes + 1))
+            note_id += args.notes
+            await conn.execute(
+                insert(Note),
+                [{"id": n, "title": f"n{n}", "user_id": user_id,
+                  "folder_id": rng.choice(folders) if rng.random() < 0.9 else None,
+                  "created_at": now, "updated_at": now - timedelta(seconds=n)}
+                 for n in notes],
+            )
+            content = base64.b64encode(os.urandom(args.content_bytes)).decode()
+            await conn.execute(
+                insert(NoteContent), [content_row(n, content) for n in notes]
+            )
+            links = [
+                {"note_id": n, "tag_id": t}
+                for n in notes
+                for t in rng.sample(tags, min(args.tags_per_note, len(tags)))
+            ]
+            if links:
+                await conn.execute(insert(NoteTag), links)
+
+            users.append({"username": f"bench{user_id}", "session_id": session_id,
+                          "notes": notes})
+    return users
+
+
+def scenarios(users, rng):
+    """name -> factory returning (method, url, headers, json body)"""
+
+    def as_user():
+        user = rng.choice(users)
+        return user, {"Cookie": f"session_id={user['session_id']}"}
+
+    def get(url):
+        def make():
+            _, headers = as_user()
+            return "GET", url, headers, None
+        return make
+
+    def login():
+        user = rng.choice(users)
+        body = {"username": user["username"], "password": PASSWORD}
+        return "POST", "/api/auth/login", {}, body
+
+    def patch_note():
+        user, headers = as_user()
+        note_id = rng.choice(user["notes"])
+        body = {"title": f"edited {rng.random():.6f}"}
+        return "PATCH", f"/api/notes/{note_id}", headers, body
+
+    return {
+        "GET /folders/tree": get("/api/folders/tree"),
+        "GET /folders/tree?fields=meta": get("/api/folders/tree?fields=meta"),
+        "GET /notes": get("/api/notes/?limit=50"),
+        "GET /tags/tree": get("/api/tags/tree"),
+        "PATCH /notes/{id}": patch_note,
+        "POST /auth/login": login,
+    }
+
+
+async def drive(client, make_request, count, concurrency):
+    from app.metrics import metrics
+
+    samples, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        method, url, headers, body = make_request()
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.request(method, url, headers=headers, json=body)
+            samples.append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 400:
+            errors += 1
+
+    queries_before = metrics.get("db_queries")
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(count)))
+    elapsed = time.perf_counter() - started
+    queries = metrics.get("db_queries") - queries_before
+
+    return {
+        "requests": count,
+        "errors": errors,
+        "throughput_rps": round(count / elapsed, 1),
+        "p50_ms": round(statistics.median(samples), 2),
+        "p95_ms": round(percentile(samples, 95), 2),
+        "p99_ms": round(percentile(samples, 99), 2),
+        "queries_per_request": round(queries / count, 2),
+    }
+
+
+async def run(args):
+    import httpx
+
+    from app.auth import shutdown_hash_pool
+    from app.database import engine
+    from app.main import app
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    users = await seed(args, rng)
+    elapsed = time.perf_counter() - started
+    print(f"seeded {args.users} users x {args.notes} notes in {elapsed:.1f}s")
+
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="https://bench") as client:
+            for name, make_request in scenarios(users, rng).items():
+                count = args.requests
+                if name == "POST /auth/login":
+                    count = args.login_requests
+                # Fills caches and starts the password hashing workers
+                if args.warmup:
+                    await drive(client, make_request, args.warmup, args.concurrency)
+                result = await drive(client, make_request, count, args.concurrency)
+                results[name] = result
+                print(
+                    f"{name:<30} {result['throughput_rps']:8.1f} req/s "
+                    f"p50={result['p50_ms']:8.2f}ms p95={result['p95_ms']:8.2f}ms "
+                    f"p99={result['p99_ms']:8.2f}ms "
+                    f"queries={result['queries_per_request']:5.2f} errors={result['errors']}"
+                )
+    finally:
+        shutdown_hash_pool()
+        await engine.dispose()
+
+    config = {key: value for key, value in vars(args).items()
+              if key not in ("json", "baseline", "tolerance")}
+    return {"config": config, "scenarios": results}
+
+
+def compare(results, baseline, tolerance):
+    """Describe every scenario that regressed against the baseline"""
+    regressions = []
+    if baseline.get("config") != results["config"]:
+        print("warning: baseline was recorded with different settings")
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms"
+            )
+        # Statement counts are deterministic, so any increase is a regression
+        if current["queries_per_request"] > previous["queries_per_request"] + 0.5:
+            regressions.append(
+                f"{name}: queries/request {previous['queries_per_request']} "
+                f"-> {current['queries_per_request']}"
+            )
+        if current["errors"] > previous["errors"]:
+            regressions.append(
+                f"{name}: errors {previous['errors']} -> {current['errors']}"
+            )
+    return regressions
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = f"sqlite:///{tmp}/bench.db"
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+        os.environ.setdefault("SESSION_REAP_INTERVAL", "0")
+        results = asyncio.run(run(args))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"wrote {args.json}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("no regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Measure how long the API takes to start serving and to shut down.
+
+    python -m bench.cold_start --runs 5 --workers 1 4
+
+Each run launches uvicorn on a throwaway SQLite database and polls /health
+until it answers. The first boot of every database applies the migrations;
+later boots only check the schema version, which is what a worker restart
+costs in production. Shutdown is timed from SIGTERM to exit.
+"""
+import argparse
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="boots per worker count")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    parser.add_argument("--timeout", type=float, default=60)
+    return parser.parse_args()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def healthy(url: str) -> bool:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+def boot(env, workers, timeout):
+    """Seconds until /health answers, and from SIGTERM until exit"""
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=BACKEND,
+        env=env,
+    )
+    try:
+        while not healthy(f"http://127.0.0.1:{port}/health"):
+            if server.poll() is not None:
+                raise RuntimeError(f"server exited with {server.returncode}")
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError("server did not become healthy in time")
+            time.sleep(0.01)
+        ready = time.perf_counter() - started
+    finally:
+        stopping = time.perf_counter()
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout)
+    return ready, time.perf_counter() - stopping
+
+
+def main():
+    args = parse_args()
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(
+                os.environ,
+                DATABASE_URL=f"sqlite:///{tmp}/cold_start.db",
+                EVENTS_SOCKET_DIR=f"{tmp}/events",
+                SESSION_REAP_INTERVAL="0",
+            )
+            if workers > 1:
+                env.setdefault("EVENTS_BROKER", "unix")
+
+            first, _ = boot(env, workers, args.timeout)
+            ready, stopped = [], []
+            for _ in range(args.runs):
+                up, down = boot(env, workers, args.timeout)
+                ready.append(up)
+                stopped.append(down)
+
+        print(
+            f"workers={workers:<3} first boot={first * 1000:7.0f}ms "
+            f"ready median={statistics.median(ready) * 1000:7.0f}ms "
+            f"max={max(ready) * 1000:7.0f}ms "
+            f"shutdown median={statistics.median(stopped) * 1000:6.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Benchmark /notes/search queries against a large single-user account.
+
+    python -m bench.search_bench --notes 100000
+
+Seeds a throwaway SQLite database, then times token, folder-subtree and
+tag-subtree searches through ``app.search.search_query``.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notes", type=int, default=100_000)
+    parser.add_argument("--vocabulary", type=int, default=20_000)
+    parser.add_argument("--tokens-per-note", type=int, default=12)
+    parser.add_argument("--folders", type=int, default=500)
+    parser.add_argument("--tags", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def seed(args, rng):
+    from sqlalchemy import insert
+
+    from app.database import engine, migrate_database
+    from app.models import Folder, Note, NoteSearchToken, NoteTag, Tag, User
+
+    await migrate_database()
+    now = datetime.now()
+    # Zipf-like token frequencies so common tokens have long posting lists
+    cum_weights = list(
+        itertools.accumulate(1 / (rank + 1) for rank in range(args.vocabulary))
+    )
+    vocabulary = [f"tok{i:06d}" for i in range(args.vocabulary)]
+
+    async with engine.begin() as conn:
+        await conn.execute(
+            insert(User),
+            [{"id": 1, "username": "bench", "email": "bench@example.com",
+              "hashed_password": "x", "salt": "x", "wrapped_master_key": "x",
+              "created_at": now}],
+        )
+        await conn.execute(
+            insert(Folder),
+            [{"id": i, "name": f"f{i}", "user_id": 1, "created_at": now,
+              "parent_id": rng.randint(1, i - 1) if i > 1 else None}
+             for i in range(1, args.folders + 1)],
+        )
+        await conn.execute(
+            insert(Tag),
+            [{"id": i, "name": f"t{i}", "user_id": 1, "created_at": now,
+              "parent_id": rng.randint(1, i - 1) if i > 1 and rng.random() < 0.7 else None}
+             for i in range(1, args.tags + 1)],
+        )
+
+        batch = 5_000
+        for start in range(1, args.notes + 1, batch):
+            ids = range(start, min(start + batch, args.notes + 1))
+            await conn.execute(
+                insert(Note),
+                [{"id": i, "title": f"n{i}", "user_id": 1,
+                  "folder_id": rng.randint(1, args.folders),
+                  "created_at": now, "updated_at": now - timedelta(seconds=i)}
+                 for i in ids],
+            )
+            await conn.execute(
+                insert(NoteSearchToken),
+                [{"note_id": i, "token": token, "user_id": 1}
+                 for i in ids
+                 for token in set(rng.choices(
+                     vocabulary, cum_weights=cum_weights, k=args.tokens_per_note
+                 ))],
+            )
+            await conn.execute(
+                insert(NoteTag),
+                [{"note_id": i, "tag_id": tag_id}
+                 for i in ids
+                 for tag_id in set(rng.choices(range(1, args.tags + 1), k=2))],
+            )
+    return vocabulary, cum_weights
+
+
+async def run(args):
+    from app.database import engine, session_factory
+    from app.search import search_query
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    vocabulary, cum_weights = await seed(args, rng)
+    print(f"seeded {args.notes} notes in {time.perf_counter() - started:.1f}s")
+
+    def pick(k):
+        return list(set(rng.choices(vocabulary, cum_weights=cum_weights, k=k)))
+
+    scenarios = {
+        "1 token": lambda: dict(tokens=pick(1)),
+        "2 tokens": lambda: dict(tokens=pick(2)),
+        "3 tokens": lambda: dict(tokens=pick(3)),
+        "token + folder subtree": lambda: dict(tokens=pick(1), folder_id=rng.randint(1, 10)),
+        "token + tag subtree": lambda: dict(tokens=pick(1), tag_id=rng.randint(1, 10)),
+    }
+
+    async with session_factory() as session:
+        for name, make_params in scenarios.items():
+            samples = []
+            for _ in range(args.queries):
+                query = search_query(1, **make_params()).limit(50)
+                start = time.perf_counter()
+                (await session.exec(query)).all()
+                samples.append((time.perf_counter() - start) * 1000)
+            print(
+                f"{name:<24} p50={statistics.median(samples):7.2f}ms "
+                f"p95={percentile(samples, 95):7.2f}ms "
+                f"p99={percentile(samples, 99):7.2f}ms"
+            )
+    await engine.dispose()
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = f"sqlite:///{tmp}/bench.db"
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Compare serialization time and bytes on the wire for a large folder tree.
+
+    python -m bench.tree_payload_bench --notes 5000
+
+Serves one prebuilt FolderTreeResponse through FastAPI's default response_model
+path and through ``orjson_response``, then compresses the body with every
+coding CompressionMiddleware can negotiate.
+"""
+import argparse
+import base64
+import gzip
+import os
+import statistics
+import time
+from datetime import datetime
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.compression import brotli, zstandard
+from app.models import FolderTreeNode, FolderTreeResponse, NoteRead, TagRead
+from app.responses import orjson_response
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notes", type=int, default=5000)
+    parser.add_argument("--folders", type=int, default=250)
+    parser.add_argument("--content-bytes", type=int, default=2048)
+    parser.add_argument("--repeat", type=int, default=10)
+    return parser.parse_args()
+
+
+def build_tree(args) -> FolderTreeResponse:
+    now = datetime.now()
+    tag = TagRead(id=1, name=base64.b64encode(os.urandom(24)).decode(), created_at=now)
+    folders = [
+        FolderTreeNode(id=folder_id, name=f"folder {folder_id}", notes=[], children=[])
+        for folder_id in range(args.folders)
+    ]
+    for note_id in range(args.notes):
+        folders[note_id % args.folders].notes.append(
+            NoteRead(
+                id=note_id,
+                # Ciphertext is random, so base64 is all compression can undo
+                title=base64.b64encode(os.urandom(48)).decode(),
+                content=base64.b64encode(os.urandom(args.content_bytes)).decode(),
+                folder_id=note_id % args.folders,
+                created_at=now,
+                updated_at=now,
+                tags=[tag],
+            )
+        )
+    return FolderTreeResponse(folders=folders, orphaned_notes=[], cursor=0)
+
+
+def build_app(tree: FolderTreeResponse) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/default", response_model=FolderTreeResponse, response_model_exclude_unset=True)
+    def default():
+        return tree
+
+    @app.get("/orjson", response_model=FolderTreeResponse, response_model_exclude_unset=True)
+    def fast():
+        return orjson_response(tree, exclude_unset=True)
+
+    return app
+
+
+def timed(fn, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return result, statistics.median(samples)
+
+
+def main():
+    args = parse_args()
+    tree = build_tree(args)
+    client = TestClient(build_app(tree))
+
+    print(f"{args.notes} notes, {args.content_bytes} content bytes each")
+    body = b""
+    for path in ("/default", "/orjson"):
+        response, ms = timed(lambda: client.get(path, headers={"Accept-Encoding": "identity"}), args.repeat)
+        body = response.content
+        print(f"{path:<10} {ms:8.1f}ms  {len(body) / 1e6:7.2f} MB")
+
+    codecs = {"gzip-6": lambda data: gzip.compress(data, compresslevel=6)}
+    if brotli is not None:
+        codecs["br-4"] = lambda data: brotli.compress(data, quality=4)
+    if zstandard is not None:
+        codecs["zstd-3"] = lambda data: zstandard.ZstdCompressor(level=3).compress(data)
+
+    for name, compress in codecs.items():
+        compressed, ms = timed(lambda: compress(body), args.repeat)
+        ratio = len(compressed) / len(body)
+        print(f"{name:<10} {ms:8.1f}ms  {len(compressed) / 1e6:7.2f} MB  ({ratio:.0%} of identity)")
+
+
+if __name__ == "__main__":
+    main()
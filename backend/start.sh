@@ -16,6 +16,36 @@ echo "========================================="
 mkdir -p /app/data
 echo "Created/verified /app/data directory"
 
-# Start uvicorn
-echo "Starting uvicorn..."
-exec uvicorn app.main:app --host 0.0.0.0 --port 8000 --proxy-headers --forwarded-allow-ips "*"
+# Apply schema migrations once, so workers only check the version on boot
+echo "Running migrations..."
+python -m app.migrations
+
+# One worker per CPU unless WEB_CONCURRENCY says otherwise
+CPUS=$(nproc)
+WORKERS="${WEB_CONCURRENCY:-$CPUS}"
+if [ "$WORKERS" -gt 1 ]; then
+    # Live change events must reach clients connected to any worker
+    export EVENTS_BROKER="${EVENTS_BROKER:-unix}"
+    # Share the cores between the workers' bcrypt pools
+    HASH_WORKERS=$((CPUS / WORKERS))
+    export PASSWORD_HASH_WORKERS="${PASSWORD_HASH_WORKERS:-$((HASH_WORKERS > 0 ? HASH_WORKERS : 1))}"
+    # Buffered autosaves live in one worker's memory, so reads and base_version
+    # checks served by another worker would miss them
+    if [ "${AUTOSAVE_BUFFER_MS:-0}" != "0" ]; then
+        echo "AUTOSAVE_BUFFER_MS needs a single worker, disabling the autosave buffer"
+    fi
+    export AUTOSAVE_BUFFER_MS=0
+fi
+
+ENV_FILE_ARGS=""
+if [ -f .env ]; then
+    ENV_FILE_ARGS="--env-file .env"
+fi
+
+# Start uvicorn. With more than one worker, "kill -HUP <pid>" restarts them
+# one at a time, so a reload never takes the API down completely.
+echo "Starting uvicorn with $WORKERS worker(s)..."
+exec uvicorn app.main:app --host 0.0.0.0 --port 8000 --proxy-headers --forwarded-allow-ips "*" \
+    --workers "$WORKERS" \
+    --timeout-graceful-shutdown "${GRACEFUL_TIMEOUT:-20}" \
+    $ENV_FILE_ARGS
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# app.database reads the URL at import, so point it at a scratch file first
+os.environ.setdefault(
+    "DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "notes.db")
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,57 @@
+import asyncio
+
+from app import revisions
+from app.content import save_contents
+from app.database import engine, migrate_database, session_factory
+from app.models import Note, User
+from app.revisions import load_revision
+
+
+async def _create_note() -> int:
+    await migrate_database()
+    async with session_factory() as session:
+        user = User(
+            username="revisions",
+            email="revisions@example.com",
+            hashed_password="",
+            salt="",
+            wrapped_master_key="",
+        )
+        session.add(user)
+        await session.flush()
+        note = Note(title="t", user_id=user.id)  # pyright: ignore[reportArgumentType]
+        session.add(note)
+        await session.commit()
+        return note.id  # pyright: ignore[reportReturnType]
+
+
+async def _save(note_id: int, content: str) -> None:
+    async with session_factory() as session:
+        await save_contents(session, {note_id: content})
+        await session.commit()
+
+
+async def _bodies(note_id: int, count: int):
+    async with session_factory() as session:
+        return [
+            (await load_revision(session, note_id, number))[1]  # pyright: ignore[reportOptionalSubscript]
+            for number in range(1, count + 1)
+        ]
+
+
+def test_folded_save_keeps_older_revisions(monkeypatch):
+    async def scenario():
+        try:
+            note_id = await _create_note()
+            await _save(note_id, "hello world AAAA")
+            # Retire the first head, then fold the next save into the new one
+            monkeypatch.setattr(revisions, "REVISION_WINDOW", 0)
+            await _save(note_id, "hello world BBBB")
+            monkeypatch.setattr(revisions, "REVISION_WINDOW", 300)
+            await _save(note_id, "XXXX completely different")
+            return await _bodies(note_id, 2)
+        finally:
+            # aiosqlite connections run on threads that would outlive the test
+            await engine.dispose()
+
+    assert asyncio.run(scenario()) == ["hello world AAAA", "XXXX completely different"]